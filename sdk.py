@@ -9,6 +9,8 @@ import distutils.spawn
 from subprocess import Popen, PIPE, STDOUT
 import configparser
 import io
+from datetime import timedelta
+from datetime import datetime
 from gi.repository import GLib
 
 SERVER_PATH="/org/sailfish/sdkrun"
@@ -17,6 +19,10 @@ SERVER_NAME="org.sailfish.sdkrun"
 TARGET_ARG="-t"
 BACKGROUND_ARG="--bg"
 FOLLOW_ARG="--follow"
+DEPLOY_ARG="--deploy"
+PRIORITY_ARG="--prio"
+ALL_TARGETS_ARG="--all-targets"
+TARGETS_ARG="--targets"
 
 STATE_CREATED   = 0
 STATE_STARTING  = 1
@@ -24,6 +30,13 @@ STATE_CANCEL    = 2
 STATE_RUNNING   = 3
 STATE_DONE      = 4
 STATE_FAIL      = 5
+STATE_STALLED   = 6
+STATE_ACTIVE    = (STATE_RUNNING, STATE_STALLED)
+
+PRIORITY        = dict()
+PRIORITY["high"]    = 0
+PRIORITY["normal"]  = 1
+PRIORITY["low"]     = 2
 
 LOG_STR = dict()
 LOG_STR[STATE_CREATED]  = "{0}"
@@ -32,6 +45,10 @@ LOG_STR[STATE_CANCEL]   = "\x1b[33m{0}\x1b[39m"
 LOG_STR[STATE_RUNNING]  = "\x1b[94m{0}\x1b[39m"
 LOG_STR[STATE_DONE]     = "\x1b[32m{0}\x1b[39m"
 LOG_STR[STATE_FAIL]     = "\x1b[31m{0}\x1b[39m"
+LOG_STR[STATE_STALLED]  = "\x1b[35m{0}\x1b[39m"
+
+# server keeps long history, only the latest tasks are listed
+TASKS_SHOWN             = 50
 
 PAGER_GUI               = [ "gvim", "-" ]
 PAGER_CLI               = [ "less", "-N" ]
@@ -49,6 +66,8 @@ def state_str(state):
         return "DONE"
     elif state == STATE_FAIL:
         return "FAIL"
+    elif state == STATE_STALLED:
+        return "STALLED"
     return "UNKNOWN"
 
 def state_short_str(state):
@@ -64,6 +83,8 @@ def state_short_str(state):
         return "d"
     elif state == STATE_FAIL:
         return "f"
+    elif state == STATE_STALLED:
+        return "!"
     return "UNKNOWN"
 
 def log_err(msg, exit=True, code=1):
@@ -72,14 +93,19 @@ def log_err(msg, exit=True, code=1):
     if exit:
         sys.exit(code)
 
+# proxy is introspected once per process
+_service = None
+
 def sdk_method(method_name):
-    bus = dbus.SessionBus()
-    try:
-        service = bus.get_object(SERVER_NAME, SERVER_PATH)
-    except dbus.exceptions.DBusException as e:
-        print("Cannot reach server: {}".format(e))
-        sys.exit(255)
-    return service.get_dbus_method(method_name, SERVER_NAME)
+    global _service
+    if _service is None:
+        bus = dbus.SessionBus()
+        try:
+            _service = bus.get_object(SERVER_NAME, SERVER_PATH)
+        except dbus.exceptions.DBusException as e:
+            print("Cannot reach server: {}".format(e))
+            sys.exit(255)
+    return _service.get_dbus_method(method_name, SERVER_NAME)
 
 def quit():
     sdk_method("Quit")()
@@ -90,8 +116,13 @@ def set_debug(enabled):
         s = True
     sdk_method("Debug")(s)
 
-def print_tasks(monitor=False):
-    tasks = sdk_method("Tasks")()
+# QueryTasks with any state and background, all of newest is 0
+def query_tasks(newest=0, pwd_prefix="", after_id=0):
+    return sdk_method("QueryTasks")(dbus.Array([], signature='i'), -1, pwd_prefix, after_id, newest)
+
+def print_tasks(monitor=False, pwd_prefix=""):
+    tasks = query_tasks(TASKS_SHOWN, pwd_prefix)
+    deploys = dict((idno, (state, ret, duration)) for idno, state, ret, duration in sdk_method("Deploys")())
     if monitor:
         # not best but shortest solution for now
         os.system("clear")
@@ -102,7 +133,10 @@ def print_tasks(monitor=False):
             if len(run_path) > 12:
                 run_path = ".." + run_path[-10:]
             line = "{0:3d} {1:<2s} {2:12s} {3:s}".format(idno, state_short_str(state), run_path, cmd)
-            print(LOG_STR[state].format(line))
+            line = LOG_STR[state].format(line)
+            if idno in deploys and deploys[idno][0] >= 0:
+                line += " " + LOG_STR[deploys[idno][0]].format("[deploy {}]".format(state_short_str(deploys[idno][0])))
+            print(line)
     elif monitor:
         print("No tasks.")
 
@@ -196,42 +230,127 @@ def follow_task(idno):
         idn, state, full_path, cmd, ret, duration = sdk_method("Task")(idno)
         if idn < 0:
             log_err("No task with id {} found.".format(idno))
-        if state != STATE_RUNNING:
+        if state not in STATE_ACTIVE:
             log_err("Task {0} [{1}] already done with return code {2}.".format(idn, cmd, ret), code=0)
     else:
-        tasks = sdk_method("Tasks")()
-        for idn, state, full_path, cmd, ret, duration in tasks:
-            if state == STATE_RUNNING and idn > idno:
-                idno = idn
-        if idno == 0:
+        running = sdk_method("RunningTaskIds")()
+        if len(running) == 0:
             log_err("No running tasks found.")
+        idno = running[0]
     follow_task_hack_execlp(idno)
 
 def latest_task_id(idno):
     if idno < 0:
-        tasks = sdk_method("Tasks")()
-        for idn, state, full_path, cmd, ret, duration in tasks:
-            if idn > idno:
-                idno = idn
+        idno = sdk_method("LatestTaskId")()
     return idno
 
-def log(idno):
+# Parse and remove log range options from sys.argv, returns (start, count)
+# for LogLines, "error" for --since-error or None for whole log.
+def parse_log_range():
+    rng = None
+    for opt in ("--tail", "--lines", "--since-error"):
+        if opt not in sys.argv:
+            continue
+        i = sys.argv.index(opt)
+        sys.argv.pop(i)
+        if opt == "--since-error":
+            rng = "error"
+            continue
+        if len(sys.argv) <= i:
+            log_err("Argument required for {}.".format(opt))
+        value = sys.argv.pop(i)
+        try:
+            if opt == "--tail":
+                rng = (-int(value), 0)
+            else:
+                first, last = value.split(":", 1)
+                first = max(int(first), 1) if first else 1
+                count = int(last) - first + 1 if last else 0
+                if last and count <= 0:
+                    log_err("Empty line range {}.".format(value))
+                rng = (first - 1, count)
+        except ValueError:
+            log_err("Invalid value for {}: {}".format(opt, value))
+    return rng
+
+def fetch_log(idno, rng=None):
+    if rng is None:
+        return sdk_method("Log")(idno)
+    if rng == "error":
+        start = sdk_method("LogErrorLine")(idno)
+        if start < 0:
+            log_err("No errors in task {}.".format(idno), code=0)
+        rng = (start, 0)
+    found, text, total = sdk_method("LogLines")(idno, rng[0], rng[1])
+    return found, text
+
+# Descriptor to the log file of task positioned after the header, or -1
+# if the log is not available as a file.
+def log_fd(idno):
+    try:
+        fds = sdk_method("LogFd")(idno)
+        if len(fds) > 0:
+            return fds[0].take()
+        return -1
+    except dbus.exceptions.DBusException:
+        pass
+    # no descriptor passing on this bus, finished logs can be read directly
+    found, path = sdk_method("LogPath")(idno)
+    if not found or not os.path.isfile(path):
+        return -1
+    with open(path, "rb") as f:
+        f.readline()
+        f.readline()
+        pos = f.tell()
+    fd = os.open(path, os.O_RDONLY)
+    os.lseek(fd, pos, os.SEEK_SET)
+    return fd
+
+def copy_fd(fd, out):
+    out.flush()
+    try:
+        while os.sendfile(out.fileno(), fd, None, 1024 * 1024) > 0:
+            pass
+    except OSError:
+        while True:
+            data = os.read(fd, 1024 * 1024)
+            if not data:
+                break
+            os.write(out.fileno(), data)
+
+def log(idno, rng=None):
     idno = latest_task_id(idno)
-    found, text = sdk_method("Log")(idno)
+    fd = -1
+    if rng is None:
+        fd = log_fd(idno)
+    if fd >= 0:
+        copy_fd(fd, sys.stdout)
+        os.close(fd)
+        return
+    found, text = fetch_log(idno, rng)
     if found:
         sys.stdout.write(text)
         sys.stdout.flush()
     else:
         log_err("No task with id {}.".format(idno))
 
-def lastlog():
+def lastlog(rng=None):
     idno = latest_task_id(-1)
-    found, text = sdk_method("Log")(idno)
+    if sys.stdin.isatty():
+        args = PAGER_CLI
+    else:
+        args = PAGER_GUI
+    # pager reads the log file directly
+    fd = -1
+    if rng is None:
+        fd = log_fd(idno)
+    if fd >= 0:
+        p = Popen(args, stdin=fd, close_fds=True)
+        os.close(fd)
+        p.wait()
+        return
+    found, text = fetch_log(idno, rng)
     if found:
-        if sys.stdin.isatty():
-            args = PAGER_CLI
-        else:
-            args = PAGER_GUI
         p = Popen(args, stdin=PIPE, close_fds=True)
         ret = p.communicate(input=text.encode())
 
@@ -243,22 +362,78 @@ def cancel(idno):
 def repeat(idno):
     repeat_idno = idno
     if idno < 0:
-        tasks = sdk_method("Tasks")()
-        for idn, state, full_path, cmd, ret, duration in reversed(tasks):
-            if idno == 0:
-                repeat_idno = idn
-                break
-            idno += 1
+        # -1 is the one before latest and so on
+        tasks = query_tasks(1 - idno)
+        if len(tasks) == 1 - idno:
+            repeat_idno = min(t[0] for t in tasks)
     elif idno == 0:
         repeat_idno = -1
     sdk_method("Repeat")(repeat_idno)
 
+def move(idno, delta):
+    if not sdk_method("MoveTask")(idno, delta):
+        log_err("Task {} is not queued or cannot be moved further.".format(idno))
+
+# Parse and remove watch options from sys.argv, returns (paths, include,
+# exclude, debounce in ms) for WatchTask.
+def parse_watch_args():
+    found = dict(path=[], include=[], exclude=[], debounce=[])
+    for opt in found.keys():
+        while "--" + opt in sys.argv:
+            i = sys.argv.index("--" + opt)
+            sys.argv.pop(i)
+            if len(sys.argv) <= i:
+                log_err("Argument required for --{}.".format(opt))
+            found[opt].append(sys.argv.pop(i))
+    debounce = 0
+    if found["debounce"]:
+        try:
+            debounce = int(found["debounce"][-1])
+        except ValueError:
+            log_err("Debounce needs to be milliseconds.")
+    paths = [os.path.abspath(p) for p in found["path"]]
+    return paths, found["include"], found["exclude"], debounce
+
+def watch(idno, args):
+    paths, include, exclude, debounce = args
+    watch_id = sdk_method("WatchTask")(idno, paths, include, exclude, debounce)
+    if watch_id < 0:
+        log_err("Cannot watch task {}.".format(idno))
+    print(watch_id)
+
+def unwatch(watch_id):
+    if not sdk_method("UnwatchTask")(watch_id):
+        log_err("No watch with id {}.".format(watch_id))
+
+def print_watches():
+    for watch_id, idno, full_path, cmd, paths, triggers in sdk_method("Watches")():
+        print("{0:3d} {1:3d} {2:4d}x {3:s} [{4:s}]".format(watch_id, idno, triggers, cmd, ", ".join(paths)))
+
+# Warnings and errors of task build, new ones first seen in it are marked,
+# others show in how many builds they have been seen.
+def print_diagnostics(idno, new_only=False):
+    diagnostics = sdk_method("Diagnostics")(idno, new_only)
+    for path, line, kind, message, builds, hits, first_seen, last_seen, new in diagnostics:
+        if new:
+            seen = "\x1b[1mNEW\x1b[0m"
+        else:
+            seen = "{0}x since {1}".format(builds, datetime.fromtimestamp(first_seen).strftime("%Y-%m-%d"))
+        color = LOG_STR[STATE_FAIL] if kind == "error" else LOG_STR[STATE_CANCEL]
+        print("{0} {1}".format(color.format("{0}:{1}: {2}: {3}".format(path, line, kind, message)), seen))
+    if len(diagnostics) == 0:
+        print("No {}diagnostics.".format("new " if new_only else ""))
+
 def reset_task_ids():
     sdk_method("Reset")()
 
 def run_cmd(pwd, cmd, background=False):
     follow = follow_created_task(cmd)
-    r = sdk_method("AddTask")(pwd, cmd, background)
+    priority = task_priority(cmd)
+    if has_deploy(cmd):
+        # server runs its configured deploy command
+        r = sdk_method("AddTaskDeploy")(pwd, cmd, background, priority, dbus.Array([], signature='s'))
+    else:
+        r = sdk_method("AddTaskPriority")(pwd, cmd, background, priority)
     if r > 0 and follow:
         follow_task_hack_execlp(r)
 
@@ -286,6 +461,23 @@ def follow_created_task(cmd):
         return True
     return False
 
+def has_deploy(cmd):
+    if DEPLOY_ARG in cmd:
+        cmd.remove(DEPLOY_ARG)
+        return True
+    return False
+
+def task_priority(cmd):
+    priority = PRIORITY["normal"]
+    if PRIORITY_ARG in cmd:
+        i = cmd.index(PRIORITY_ARG)
+        if len(cmd) < i + 2 or cmd[i + 1] not in PRIORITY:
+            log_err("Usage: {0} {{{1}}}".format(PRIORITY_ARG, "|".join(PRIORITY.keys())))
+        priority = PRIORITY[cmd[i + 1]]
+        cmd.pop(i)
+        cmd.pop(i)
+    return priority
+
 def apply_default(cmd, final):
     use_default = True
     if TARGET_ARG in cmd:
@@ -300,9 +492,35 @@ def apply_default(cmd, final):
         if default:
             final.extend([TARGET_ARG, default])
 
+# Parse and remove --all-targets and --targets a,b,c from cmd, returns list
+# of targets or None when command is run only for one target.
+def fanout_targets(cmd):
+    targets = None
+    if ALL_TARGETS_ARG in cmd:
+        cmd.remove(ALL_TARGETS_ARG)
+        targets = sorted(sb2_targets())
+    if TARGETS_ARG in cmd:
+        i = cmd.index(TARGETS_ARG)
+        if len(cmd) < i + 2:
+            log_err("Comma separated list of targets required for {}.".format(TARGETS_ARG))
+        targets = [t for t in cmd[i + 1].split(",") if t]
+        cmd.pop(i)
+        cmd.pop(i)
+        known = sb2_targets()
+        for t in targets:
+            if t not in known:
+                log_err("Target '{}' not found.".format(t))
+    if targets is not None and len(targets) == 0:
+        log_err("No targets found.")
+    return targets
+
 def run_target_cmd(pwd, exe, cmd):
     final = [exe]
     bg = is_background(cmd)
+    targets = fanout_targets(cmd)
+    if targets:
+        run_group(pwd, targets, [[exe, TARGET_ARG, t] + cmd for t in targets], bg)
+        return
     apply_default(cmd, final)
     final.extend(cmd)
     run_cmd(pwd, final, bg)
@@ -310,11 +528,86 @@ def run_target_cmd(pwd, exe, cmd):
 def run_sdk_install(pwd, cmd):
     final = ['sb2']
     bg = is_background(cmd)
+    targets = fanout_targets(cmd)
+    if targets:
+        install = ['-m', 'sdk-install', '-R'] + cmd
+        run_group(pwd, targets, [['sb2', TARGET_ARG, t] + install for t in targets], bg)
+        return
     apply_default(cmd, final)
     final.extend(['-m', 'sdk-install', '-R'])
     final.extend(cmd)
     run_cmd(pwd, final, bg)
 
+# Waits until all tasks of a group have finished.
+class GroupWaiter():
+    def __init__(self, ids):
+        self._ids = ids
+        self.results = {}
+        bus = dbus.SessionBus()
+        bus.add_signal_receiver(self.task_handler,
+                                dbus_interface=SERVER_NAME,
+                                signal_name="TaskStateChanged")
+        self.mainloop = GLib.MainLoop()
+
+    def _update(self):
+        for idno in self._ids:
+            self.results[idno] = sdk_method("Task")(idno)
+        if all(r[1] in (STATE_DONE, STATE_FAIL, STATE_CANCEL) or r[0] < 0 for r in self.results.values()):
+            self.mainloop.quit()
+        return False
+
+    def run(self):
+        GLib.idle_add(self._update)
+        try:
+            self.mainloop.run()
+        except KeyboardInterrupt as e:
+            self.mainloop.quit()
+            return False
+        return True
+
+    def task_handler(self, new_state, task_id, task_pwd, task_cmd, duration):
+        if task_id in self._ids and new_state in (STATE_DONE, STATE_FAIL, STATE_CANCEL):
+            self._update()
+
+def print_matrix(targets, ids, results):
+    width = max(len(t) for t in targets + ["[target]"])
+    print("\x1b[30;107m{0:{w}s}\x1b[39;49m \x1b[30;107m{1:8s}\x1b[39;49m \x1b[30;107m{2:>5s}\x1b[39;49m \x1b[30;107m{3:>8s}\x1b[39;49m \x1b[30;107m{4:>5s}\x1b[39;49m".format(
+        "[target]", "[state]", "[ret]", "[time]", "[id]", w=width))
+    for target, idno in zip(targets, ids):
+        idn, state, full_path, cmd, ret, duration = results[idno]
+        if idn < 0:
+            print("{0:{w}s} {1:8s}".format(target, "UNKNOWN", w=width))
+            continue
+        line = "{0:{w}s} {1:8s} {2:5d} {3:>8s} {4:5d}".format(
+            target, state_str(state), ret, str(timedelta(seconds=max(duration, 0))), idn, w=width)
+        print(LOG_STR[state].format(line))
+
+# Run one command per target as a task group and report pass/fail per target.
+# With background the tasks are only queued.
+def run_group(pwd, targets, cmds, background=False):
+    follow_created_task(cmds[0])
+    priority = task_priority(cmds[0])
+    for cmd in cmds[1:]:
+        follow_created_task(cmd)
+        task_priority(cmd)
+    if DEPLOY_ARG in cmds[0]:
+        log_err("{} cannot be used with multiple targets.".format(DEPLOY_ARG))
+    # main loop needs to be set before the bus is first used to get signals
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    ids = [int(i) for i in sdk_method("AddTaskGroup")(pwd, cmds, priority)]
+    if len(ids) == 0:
+        log_err("Failed to add tasks.")
+    for target, idno in zip(targets, ids):
+        print("{0:3d} {1}".format(idno, target))
+    if background:
+        return
+    waiter = GroupWaiter(ids)
+    if not waiter.run():
+        log_err("Tasks are left running.", code=130)
+    print_matrix(targets, ids, waiter.results)
+    if any(waiter.results[i][1] != STATE_DONE for i in ids):
+        sys.exit(1)
+
 def set_default_target(name):
     cmd = ['sb2-config', '-d', name]
     run_cmd(os.path.expanduser("~"), cmd)
@@ -350,25 +643,18 @@ def sb2_default_target():
             set_default_target(ret.decode().split("\n")[0])
 
 def parse_last_path():
-    tasks = sdk_method("Tasks")()
-    path = None
-    idno = 0
-    for idn, state, full_path, cmd, ret, duration in tasks:
-        if idn > idno:
-            idno = idn
-            path = full_path
-    if path:
-        print(path)
+    idno = sdk_method("LatestTaskId")()
+    task = sdk_method("Task")(idno) if idno >= 0 else None
+    if task and task[0] >= 0 and task[2]:
+        print(task[2])
     else:
         sys.exit(1)
 
 def parse_running_id():
-    tasks = sdk_method("Tasks")()
-    for idn, state, full_path, cmd, ret, duration in tasks:
-        if state == STATE_RUNNING:
-            print(idn)
-            sys.exit(0)
-    sys.exit(1)
+    running = sdk_method("RunningTaskIds")()
+    if len(running) == 0:
+        sys.exit(1)
+    print(running[0])
 
 def sys_args1(*argv):
     if len(sys.argv) > 1:
@@ -406,9 +692,9 @@ def main():
 
     elif cmd == "tasks":
         if sys_args1("--autocomplete"):
-            print("--monitor -m --follow -f --log -l")
+            print("--monitor -m --follow -f --log -l --bump --lower --tail --lines --since-error --watch --unwatch --watches --path --include --exclude --debounce --diagnostics --new --here")
         elif sys_args1("--autocomplete2"):
-            print("--follow|-f|--log|-l")
+            print("--follow|-f|--log|-l|--bump|--lower|--watch|--diagnostics")
         elif sys_args1("--monitor", "-m"):
             monitor_tasks()
         elif sys_args1("--follow", "-f"):
@@ -416,12 +702,31 @@ def main():
         elif sys_args1("--follow-hack"):
             follow_task_hack(sys_int_val(2))
         elif sys_args1("--log", "-l"):
-            log(sys_int_val(2, default=-1))
+            rng = parse_log_range()
+            log(sys_int_val(2, default=-1), rng)
+        elif sys_args1("--bump"):
+            move(sys_int_val(2), -1)
+        elif sys_args1("--lower"):
+            move(sys_int_val(2), 1)
+        elif sys_args1("--watch"):
+            args = parse_watch_args()
+            watch(sys_int_val(2, default=-1), args)
+        elif sys_args1("--unwatch"):
+            unwatch(sys_int_val(2))
+        elif sys_args1("--watches"):
+            print_watches()
+        elif sys_args1("--here"):
+            print_tasks(pwd_prefix=os.getcwd())
+        elif sys_args1("--diagnostics"):
+            new_only = "--new" in sys.argv
+            if new_only:
+                sys.argv.remove("--new")
+            print_diagnostics(sys_int_val(2, default=-1), new_only)
         else:
             print_tasks()
 
     elif cmd == "lastlog":
-        lastlog()
+        lastlog(parse_log_range())
 
     elif cmd == "cancel":
         if sys_args1("all"):
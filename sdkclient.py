@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+# Asyncio client for server-sdk.py. Keeps one D-Bus connection and cached
+# method proxies so that scripts can submit and follow lots of tasks from
+# a single process:
+#
+#   import asyncio
+#   from sdkclient import SdkClient
+#
+#   async def main():
+#       async with SdkClient() as client:
+#           ids = await client.submit_batch([["mb2", "-t", t, "build"] for t in targets], pwd=src)
+#           async for line in client.stream(ids[0]):
+#               print(line, end="")
+#           results = await asyncio.gather(*(client.wait(i) for i in ids))
+#
+#   asyncio.run(main())
+#
+# D-Bus is dispatched by a GLib main loop in a thread of its own, replies
+# and signals are handed over to the asyncio loop.
+
+import asyncio
+import threading
+from collections import namedtuple
+
+import dbus
+import dbus.bus
+import dbus.mainloop.glib
+from gi.repository import GLib
+
+SERVER_PATH = "/org/sailfish/sdkrun"
+SERVER_NAME = "org.sailfish.sdkrun"
+
+STATE_CREATED   = 0
+STATE_STARTING  = 1
+STATE_CANCEL    = 2
+STATE_RUNNING   = 3
+STATE_DONE      = 4
+STATE_FAIL      = 5
+STATE_STALLED   = 6
+STATE_FINISHED  = (STATE_DONE, STATE_FAIL, STATE_CANCEL)
+
+PRIORITY        = dict()
+PRIORITY["high"]    = 0
+PRIORITY["normal"]  = 1
+PRIORITY["low"]     = 2
+
+# output of running task is read this often unless its state changes
+STREAM_POLL_INTERVAL = 0.2
+
+TaskInfo = namedtuple("TaskInfo", ["id", "state", "pwd", "cmdline", "returncode", "duration"])
+
+
+class SdkError(Exception):
+    pass
+
+
+def _set_result(future, value):
+    if not future.done():
+        future.set_result(value)
+
+def _set_exception(future, e):
+    if not future.done():
+        future.set_exception(e)
+
+
+class SdkClient():
+    def __init__(self):
+        self._loop = None
+        self._bus = None
+        self._proxy = None
+        self._methods = {}
+        self._receiver = None
+        self._glib_loop = None
+        self._thread = None
+        self._waiters = {}
+        self._streams = {}
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    async def connect(self):
+        self._loop = asyncio.get_running_loop()
+        dbus.mainloop.glib.threads_init()
+        self._bus = dbus.bus.BusConnection(dbus.bus.BUS_SESSION, mainloop=dbus.mainloop.glib.DBusGMainLoop())
+        self._glib_loop = GLib.MainLoop()
+        self._thread = threading.Thread(target=self._glib_loop.run, daemon=True)
+        self._thread.start()
+        try:
+            self._proxy = await self._loop.run_in_executor(None, self._bus.get_object, SERVER_NAME, SERVER_PATH)
+        except dbus.exceptions.DBusException as e:
+            self.close()
+            raise SdkError("Cannot reach server: {}".format(e))
+        self._receiver = self._bus.add_signal_receiver(self._state_changed,
+                                                       dbus_interface=SERVER_NAME,
+                                                       signal_name="TaskStateChanged")
+
+    def close(self):
+        if self._receiver:
+            self._receiver.remove()
+            self._receiver = None
+        if self._glib_loop:
+            self._glib_loop.quit()
+            self._glib_loop = None
+        if self._bus:
+            self._bus.close()
+            self._bus = None
+        for futures in self._waiters.values():
+            for future in futures:
+                _set_exception(future, SdkError("Connection closed"))
+        self._waiters = {}
+
+    def _method(self, name):
+        method = self._methods.get(name)
+        if method is None:
+            method = self._proxy.get_dbus_method(name, SERVER_NAME)
+            self._methods[name] = method
+        return method
+
+    # Non-blocking call, replies arrive in GLib thread and are passed to
+    # the returned future.
+    def _call(self, name, *args):
+        future = self._loop.create_future()
+
+        def reply(*ret):
+            value = None
+            if len(ret) == 1:
+                value = ret[0]
+            elif len(ret) > 1:
+                value = ret
+            self._loop.call_soon_threadsafe(_set_result, future, value)
+
+        def error(e):
+            self._loop.call_soon_threadsafe(_set_exception, future, SdkError(str(e)))
+
+        self._method(name)(*args, reply_handler=reply, error_handler=error)
+        return future
+
+    # called from GLib thread
+    def _state_changed(self, new_state, task_id, task_pwd, task_cmd, duration):
+        self._loop.call_soon_threadsafe(self._task_changed, int(task_id), int(new_state))
+
+    def _task_changed(self, idno, state):
+        for event in self._streams.get(idno, []):
+            event.set()
+        if state in STATE_FINISHED:
+            for future in self._waiters.pop(idno, []):
+                _set_result(future, state)
+
+    async def submit(self, cmd, pwd, background=False, priority="normal", deploy=False):
+        if priority not in PRIORITY:
+            raise SdkError("Priority needs to be one of: {}".format(", ".join(PRIORITY.keys())))
+        cmd = [str(c) for c in cmd]
+        if deploy:
+            idno = await self._call("AddTaskDeploy", pwd, cmd, background, PRIORITY[priority], dbus.Array([], signature='s'))
+        else:
+            idno = await self._call("AddTaskPriority", pwd, cmd, background, PRIORITY[priority])
+        if idno < 0:
+            raise SdkError("Failed to add task {}".format(" ".join(cmd)))
+        return int(idno)
+
+    # Calls are sent without waiting for replies in between, server adds
+    # tasks in the order of cmds.
+    async def submit_batch(self, cmds, pwd, **kwargs):
+        return list(await asyncio.gather(*(self.submit(cmd, pwd, **kwargs) for cmd in cmds)))
+
+    async def task(self, idno):
+        info = TaskInfo(*(await self._call("Task", idno)))
+        if info.id < 0:
+            return None
+        return info
+
+    # Waits until task has finished, returns its TaskInfo or None if there
+    # is no such task.
+    async def wait(self, idno):
+        future = self._loop.create_future()
+        self._waiters.setdefault(idno, []).append(future)
+        info = await self.task(idno)
+        if info is None or info.state in STATE_FINISHED:
+            if future in self._waiters.get(idno, []):
+                self._waiters[idno].remove(future)
+            return info
+        await future
+        return await self.task(idno)
+
+    async def run(self, cmd, pwd, **kwargs):
+        return await self.wait(await self.submit(cmd, pwd, **kwargs))
+
+    # Yields output lines of task from the start until it has finished.
+    # New lines are read from the server log index so that nothing is lost
+    # or repeated.
+    async def stream(self, idno):
+        event = asyncio.Event()
+        self._streams.setdefault(idno, []).append(event)
+        pos = 0
+        try:
+            while True:
+                event.clear()
+                # state first, output read after finishing is complete
+                info = await self.task(idno)
+                found, text, total = await self._call("LogLines", idno, pos, 0)
+                if not found:
+                    return
+                for line in text.splitlines(True):
+                    yield line
+                pos = total
+                if info is None or info.state in STATE_FINISHED:
+                    return
+                try:
+                    await asyncio.wait_for(event.wait(), STREAM_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._streams[idno].remove(event)
+            if not self._streams[idno]:
+                del self._streams[idno]
+
+    async def cancel(self, idno):
+        await self._call("CancelTask", idno)
+
+    async def log(self, idno):
+        found, text = await self._call("Log", idno)
+        if not found:
+            raise SdkError("No task with id {}".format(idno))
+        return text
+
+    # Tasks filtered by server, see QueryTasks.
+    async def tasks(self, states=None, background=None, pwd_prefix="", after_id=0, newest=0):
+        states = dbus.Array([int(s) for s in states or []], signature='i')
+        bg = -1 if background is None else int(bool(background))
+        return [TaskInfo(*t) for t in await self._call("QueryTasks", states, bg, pwd_prefix, after_id, newest)]
+
+    async def latest_id(self):
+        return int(await self._call("LatestTaskId"))
+
+    async def running_ids(self):
+        return [int(i) for i in await self._call("RunningTaskIds")]
@@ -9,12 +9,17 @@ from gi.repository import GObject as gobject
 
 TASK_DONE = 4
 TASK_FAIL = 5
+TASK_STALLED = 6
 
 MIN_DONE_DURATION = 10
 MIN_FAIL_DURATION = 0.5
 DIALOG_DURATION = 6000
 
 def state_changed_handler(new_state, task_id, task_pwd, task_cmd, duration):
+    if new_state == TASK_STALLED:
+        os.system('notify-send -a SDK -t %d -i %s "%s" "%s"' % (DIALOG_DURATION, "dialog-warning", "STALLED", task_cmd))
+        return
+
     if new_state != TASK_DONE and new_state != TASK_FAIL:
         return
 
@@ -31,6 +36,18 @@ def state_changed_handler(new_state, task_id, task_pwd, task_cmd, duration):
 
     os.system('notify-send -a SDK -t %d -i %s "%s" "%s"' % (DIALOG_DURATION, icon, header, task_cmd))
 
+def deploy_state_changed_handler(new_state, task_id, task_pwd, task_cmd, duration):
+    if new_state == TASK_DONE:
+        icon = "dialog-information"
+        header = "DEPLOYED"
+    elif new_state == TASK_FAIL:
+        icon = "dialog-error"
+        header = "DEPLOY FAILED"
+    else:
+        return
+
+    os.system('notify-send -a SDK -t %d -i %s "%s" "%s"' % (DIALOG_DURATION, icon, header, task_cmd))
+
 def main():
     dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
     bus = dbus.SessionBus()
@@ -38,6 +55,9 @@ def main():
     bus.add_signal_receiver(state_changed_handler,
                             dbus_interface='org.sailfish.sdkrun',
                             signal_name='TaskStateChanged')
+    bus.add_signal_receiver(deploy_state_changed_handler,
+                            dbus_interface='org.sailfish.sdkrun',
+                            signal_name='TaskDeployStateChanged')
     loop.run()
 
 if __name__ == "__main__":
@@ -9,6 +9,21 @@ import sys
 import time
 import queue
 import traceback
+import socket
+import json
+import argparse
+import shutil
+import struct
+import ctypes
+import ctypes.util
+import errno
+import select
+import fnmatch
+import shlex
+import sqlite3
+import hashlib
+import hmac
+import secrets
 from datetime import timedelta
 from datetime import datetime
 from unicodedata import normalize
@@ -25,9 +40,56 @@ SERVICE_PATH = "/org/sailfish/sdkrun"
 
 BUILD_LOGS_ENABLED  = True
 BUILD_LOGS_PATH     = ".build_logs"
-
-TASK_HISTORY_LENGTH = 50
+# Each log has an index <log>.idx with the offset of every output line as
+# little endian uint64, highest bit set for lines matching an error.
+LOG_INDEX_SUFFIX    = ".idx"
+LOG_INDEX_ENTRY     = struct.Struct("<Q")
+LOG_INDEX_ERROR     = 1 << 63
+# Warnings and errors of all builds are kept deduplicated per project
+DIAGNOSTICS_DB      = "diagnostics.db"
+
+# finished tasks are kept as FinishedTask records, about 0.5kB each
+TASK_HISTORY_LENGTH = 10000
+WORKER_PORT         = 7733
+WORKER_SLOTS        = 1
+WORKER_RETRY_DELAY  = 5
+# workers are accepted only from this address unless told otherwise and
+# they need to present the token from WORKER_TOKEN_FILE in home
+WORKER_ADDRESS      = "localhost"
+WORKER_TOKEN_FILE   = ".sdk_worker_token"
+# seconds to wait for worker to start or reject a task
+WORKER_ACK_TIMEOUT  = 30
+# tasks of one group (same command for several targets) run concurrently
+# in at most GROUP_SLOTS local processes. Builds with these commands write
+# into the source tree and are never run concurrently in the same directory.
+GROUP_SLOTS         = 2
+IN_TREE_BUILD_CMDS  = ["mb2"]
+LOW_PRIO_NICE       = 10
+LOW_PRIO_IONICE     = ["-c", "2", "-n", "7"]
 MIN_LINES_FOR_ERROR = 20
+# task without output or cpu use for STALL_TIMEOUT seconds is marked stalled
+# and with STALL_KILL_TIMEOUT it is killed, 0 disables
+STALL_TIMEOUT       = 300
+STALL_KILL_TIMEOUT  = 0
+STALL_CHECK_INTERVAL = 5
+# run after successful task declaring deploy stage when it changed packages
+# in RPMS directory, changed package paths are in SDK_CHANGED_RPMS and
+# install-built installs only those. SDK_NO_WATCH keeps it from waiting for
+# files, deploy still running after DEPLOY_TIMEOUT seconds is killed, 0
+# disables
+DEPLOY_CMD          = ["install-built"]
+DEPLOY_TIMEOUT      = 600
+DEPLOY_RPMS_DIR     = "RPMS"
+# watched tasks are queued again WATCH_DEBOUNCE seconds after the last change
+WATCH_DEBOUNCE      = 0.5
+# changes to files matching these are ignored by default, mostly build output
+# written into the source tree. Changes made while the watched task runs
+# queue it again once it has finished.
+WATCH_EXCLUDE       = [".git", ".svn", ".build_logs", "RPMS", "BUILDROOT", "*.o", "*.lo", "*.a", "*.so", "*.so.*",
+                       "moc_*", "*.moc", "qrc_*", "ui_*.h", "*.qm", "Makefile", ".qmake.stash",
+                       "CMakeFiles", "CMakeCache.txt", "cmake_install.cmake", "debugfiles.list",
+                       "debuglinks.list", "debugsources.list", "elfbins.list", "documentation.list",
+                       "__pycache__", "*.pyc", "*.swp", "*.swx", "*~", "4913", ".#*", "*.tmp"]
 ERROR_STR           = "\x1b[31m{}\x1b[39m"
 WARN_STR            = "\x1b[33m{}\x1b[39m"
 LOG_STATE_STR       = "\x1b[33m({0:>3})\x1b[39m [\x1b[32m{1}\x1b[39m] {2}"
@@ -35,20 +97,163 @@ LOG_SUCCESS_STR     = "\x1b[32mSUCCESS\x1b[39m"
 LOG_CANCEL_STR      = "\x1b[33mCANCEL\x1b[39m"
 LOG_FAIL_STR        = "\x1b[31mFAIL\x1b[39m"
 
+LINE_MATCH = []
+#                        regex                                    format      is error
+LINE_MATCH.append((re.compile(r'^.*:\d+:\d+: error:'),                 ERROR_STR,  True    ))
+LINE_MATCH.append((re.compile(r'^.*:\d+:\d+: fatal error:'),           ERROR_STR,  True    ))
+LINE_MATCH.append((re.compile(r'^.*No rule to make target.*Stop.'),    ERROR_STR,  True    ))
+LINE_MATCH.append((re.compile(r'^.*:\d+: error:'),                     ERROR_STR,  True    ))
+LINE_MATCH.append((re.compile(r'^.*: error:'),                         ERROR_STR,  True    ))
+LINE_MATCH.append((re.compile(r'^FAILED:'),                            ERROR_STR,  True    ))
+LINE_MATCH.append((re.compile(r'^.*:\d+: undefined reference to'),     ERROR_STR,  True    ))
+LINE_MATCH.append((re.compile(r'^.*:\d+:\d+: warning:'),               WARN_STR,   False   ))
+
+# compiler diagnostics collected to diagnostics store
+DIAGNOSTIC_MATCH = re.compile(r'^(?P<file>[^:\s][^:]*):(?P<line>\d+):(?:\d+:)? (?P<kind>warning|error|fatal error): (?P<message>.*?)\s*$')
+
+def is_error_line(line):
+    for regex, pr, error in LINE_MATCH:
+        if regex.match(line):
+            return error
+    return False
+
+# Resolve start (negative counts from end) and count (<= 0 to end) to a
+# range of lines.
+def line_range(total, start, count):
+    if start < 0:
+        start = max(total + start, 0)
+    start = min(start, total)
+    end = total
+    if count > 0:
+        end = min(start + count, total)
+    return start, end
+
+# Log or its index may have been removed or rotated away, that reads as an
+# empty log.
+def read_log_lines(log_fn, start, count):
+    try:
+        return _read_log_lines(log_fn, start, count)
+    except (OSError, struct.error):
+        return "", 0
+
+def _read_log_lines(log_fn, start, count):
+    index_fn = log_fn + LOG_INDEX_SUFFIX
+    total = os.path.getsize(index_fn) // LOG_INDEX_ENTRY.size
+    start, end = line_range(total, start, count)
+    if start == end:
+        return "", total
+    with open(index_fn, "rb") as f:
+        f.seek(start * LOG_INDEX_ENTRY.size)
+        begin = LOG_INDEX_ENTRY.unpack(f.read(LOG_INDEX_ENTRY.size))[0] & ~LOG_INDEX_ERROR
+        stop = None
+        if end < total:
+            f.seek(end * LOG_INDEX_ENTRY.size)
+            stop = LOG_INDEX_ENTRY.unpack(f.read(LOG_INDEX_ENTRY.size))[0] & ~LOG_INDEX_ERROR
+    with open(log_fn, "rb") as f:
+        f.seek(begin)
+        data = f.read(stop - begin) if stop is not None else f.read()
+    return data.decode('utf-8', 'replace'), total
+
+def first_error_line(log_fn):
+    try:
+        with open(log_fn + LOG_INDEX_SUFFIX, "rb") as f:
+            lineno = 0
+            while True:
+                chunk = f.read(LOG_INDEX_ENTRY.size * 4096)
+                if not chunk:
+                    return -1
+                for (entry,) in LOG_INDEX_ENTRY.iter_unpack(chunk):
+                    if entry & LOG_INDEX_ERROR:
+                        return lineno
+                    lineno += 1
+    except (OSError, struct.error):
+        return -1
+
+# Same diagnostic in other builds has the same fingerprint even if numbers
+# like sizes or addresses in its message change.
+def diagnostic_fingerprint(message):
+    normalized = " ".join(re.sub(r'0x[0-9a-fA-F]+|\d+', '#', message).split())
+    return hashlib.sha1(normalized.encode()).hexdigest()[:16]
+
+# (file, line, fingerprint) -> [kind, message, count] of diagnostic in line
+# or None if line is not a diagnostic. File is made relative to pwd.
+def parse_diagnostic(pwd, line):
+    m = DIAGNOSTIC_MATCH.match(line)
+    if not m:
+        return None
+    path = os.path.normpath(m.group("file"))
+    if os.path.isabs(path) and path.startswith(pwd + os.sep):
+        path = os.path.relpath(path, pwd)
+    kind = "error" if m.group("kind") != "warning" else "warning"
+    message = m.group("message")
+    return (path, int(m.group("line")), diagnostic_fingerprint(message)), kind, message
+
+
+# Diagnostics of every build deduplicated by project (task directory), file,
+# line and message fingerprint. Build where diagnostic was first and last
+# seen are indexed so that new ones are found without scanning history.
+class DiagnosticStore():
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS builds "
+                         "(id INTEGER PRIMARY KEY AUTOINCREMENT, project TEXT, task INTEGER, time INTEGER)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS diagnostics "
+                         "(project TEXT, file TEXT, line INTEGER, fingerprint TEXT, kind TEXT, message TEXT, "
+                         "first_build INTEGER, last_build INTEGER, first_seen INTEGER, last_seen INTEGER, "
+                         "builds INTEGER, hits INTEGER, PRIMARY KEY (project, file, line, fingerprint))")
+        # diagnostics seen in each build
+        self._db.execute("CREATE TABLE IF NOT EXISTS build_diagnostics "
+                         "(build INTEGER, diagnostic INTEGER, hits INTEGER, PRIMARY KEY (build, diagnostic))")
+        self._db.execute("CREATE INDEX IF NOT EXISTS diagnostics_first ON diagnostics (first_build)")
+        self._db.commit()
+
+    # Add diagnostics {(file, line, fingerprint): [kind, message, count]}
+    # of task run as new build, returns (build id, new count, total count).
+    # Tasks keep their build id, task ids restart after reset.
+    def record(self, project, task_id, diagnostics):
+        now = int(time.time())
+        new = 0
+        with self._lock:
+            cur = self._db.cursor()
+            cur.execute("INSERT INTO builds (project, task, time) VALUES (?, ?, ?)", (project, task_id, now))
+            build = cur.lastrowid
+            for (path, line, fingerprint), (kind, message, count) in diagnostics.items():
+                row = cur.execute("SELECT rowid FROM diagnostics WHERE project = ? AND file = ? AND line = ? AND fingerprint = ?",
+                                  (project, path, line, fingerprint)).fetchone()
+                if row:
+                    diagnostic = row[0]
+                    cur.execute("UPDATE diagnostics SET kind = ?, message = ?, last_build = ?, last_seen = ?, "
+                                "builds = builds + 1, hits = hits + ? WHERE rowid = ?",
+                                (kind, message, build, now, count, diagnostic))
+                else:
+                    cur.execute("INSERT INTO diagnostics VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1, ?)",
+                                (project, path, line, fingerprint, kind, message, build, build, now, now, count))
+                    diagnostic = cur.lastrowid
+                    new += 1
+                cur.execute("INSERT INTO build_diagnostics VALUES (?, ?, ?)", (build, diagnostic, count))
+            self._db.commit()
+        return build, new, len(diagnostics)
+
+    # Diagnostics seen in build, only those first seen in it with new_only.
+    def query(self, build, new_only=False):
+        where = "AND d.first_build = ? " if new_only else ""
+        args = (build, build, build) if new_only else (build, build)
+        with self._lock:
+            return self._db.execute("SELECT d.file, d.line, d.kind, d.message, d.builds, d.hits, d.first_seen, d.last_seen, "
+                                    "d.first_build = ? FROM build_diagnostics b JOIN diagnostics d ON d.rowid = b.diagnostic "
+                                    "WHERE b.build = ? " + where + "ORDER BY d.kind, d.file, d.line", args).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
 class WorkerPrinter():
     def __init__(self, debug=False):
         self.reset()
 
-        self._match = []
-        #                              regex                                    format      is error
-        self._match.append((re.compile(r'^.*:\d+:\d+: error:'),                 ERROR_STR,  True    ))
-        self._match.append((re.compile(r'^.*:\d+:\d+: fatal error:'),           ERROR_STR,  True    ))
-        self._match.append((re.compile(r'^.*No rule to make target.*Stop.'),    ERROR_STR,  True    ))
-        self._match.append((re.compile(r'^.*:\d+: error:'),                     ERROR_STR,  True    ))
-        self._match.append((re.compile(r'^.*: error:'),                         ERROR_STR,  True    ))
-        self._match.append((re.compile(r'^FAILED:'),                            ERROR_STR,  True    ))
-        self._match.append((re.compile(r'^.*:\d+: undefined reference to'),     ERROR_STR,  True    ))
-        self._match.append((re.compile(r'^.*:\d+:\d+: warning:'),               WARN_STR,   False   ))
+        self._match = LINE_MATCH
 
         self._queue = queue.Queue()
         self._running = True
@@ -108,6 +313,610 @@ class WorkerPrinter():
         self._print("")
 
 
+# RPMS directory of build in pwd, looked up towards root like install-built does.
+def find_rpms_dir(pwd):
+    path = os.path.abspath(pwd)
+    while True:
+        candidate = os.path.join(path, DEPLOY_RPMS_DIR)
+        if os.path.isdir(candidate):
+            return candidate
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+# Returns (children of pid, cpu time of pid in clock ticks including its
+# children already waited for) for all processes.
+def read_process_tree():
+    parents = {}
+    cpu = {}
+    for p in os.listdir("/proc"):
+        if not p.isdigit():
+            continue
+        try:
+            with open("/proc/{}/stat".format(p)) as f:
+                data = f.read()
+        except OSError:
+            continue
+        # command name may contain spaces and parentheses
+        fields = data[data.rindex(")") + 2:].split()
+        pid = int(p)
+        parents[pid] = int(fields[1])
+        cpu[pid] = sum(int(v) for v in fields[11:15])
+    children = {}
+    for pid, ppid in parents.items():
+        children.setdefault(ppid, []).append(pid)
+    return children, cpu
+
+def descendants(root, children):
+    found = [root]
+    i = 0
+    while i < len(found):
+        found.extend(children.get(found[i], []))
+        i += 1
+    return found
+
+# Cpu time used by each root pid and all its descendants.
+def tree_cpu_times(roots):
+    children, cpu = read_process_tree()
+    times = {}
+    for root in roots:
+        if root in cpu:
+            times[root] = sum(cpu.get(pid, 0) for pid in descendants(root, children))
+    return times
+
+# Kill pid and its descendants, killing only the parent could leave children
+# holding the output pipe open.
+def kill_tree(root):
+    children, cpu = read_process_tree()
+    for pid in descendants(root, children):
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+# name -> (mtime, size) of packages in rpms_dir
+def rpm_snapshot(rpms_dir):
+    snapshot = {}
+    if not rpms_dir:
+        return snapshot
+    try:
+        for entry in os.scandir(rpms_dir):
+            if entry.name.endswith(".rpm") and entry.is_file():
+                st = entry.stat()
+                snapshot[entry.name] = (st.st_mtime_ns, st.st_size)
+    except OSError:
+        pass
+    return snapshot
+
+# kill process started in a session of its own with its children
+def kill_group(process):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+# Background and low priority tasks are run with lower cpu and io priority.
+def niced_command(argv, low):
+    if not low:
+        return argv
+    prefix = ["nice", "-n", str(LOW_PRIO_NICE)]
+    if shutil.which("ionice"):
+        prefix += ["ionice"] + LOW_PRIO_IONICE
+    return prefix + argv
+
+
+# Messages between coordinator and worker daemons are single line json objects.
+def send_message(conn, lock, **msg):
+    data = "{}\n".format(json.dumps(msg)).encode()
+    with lock:
+        conn.sendall(data)
+
+def read_messages(stream):
+    for raw in stream:
+        try:
+            yield json.loads(raw.decode())
+        except ValueError:
+            continue
+
+# Shared secret of coordinator and workers. Coordinator creates it when it
+# doesn't exist, it needs to be copied to the same path in worker hosts.
+def worker_token(path, create=False):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        if not create:
+            return None
+    token = secrets.token_hex(32)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(token + "\n")
+    return token
+
+# HEAD commit of git checkout in path, None if not known
+def checkout_revision(path):
+    try:
+        out = subprocess.run(["git", "-C", path, "rev-parse", "HEAD"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except OSError:
+        return None
+    if out.returncode != 0:
+        return None
+    return out.stdout.decode().strip()
+
+
+# Worker did not start the task, it can be run elsewhere.
+class WorkerRejected(Exception):
+    pass
+
+
+# Popen like handle for a task running in a remote worker.
+class RemoteProcess():
+    def __init__(self, worker, idno):
+        self._worker = worker
+        self._idno = idno
+        self._lines = queue.Queue()
+        self._acked = threading.Event()
+        self._rejected = None
+        self.returncode = None
+        self.stdin = None
+        self.stdout = self
+        self.stderr = None
+
+    def readline(self):
+        return self._lines.get()
+
+    def close(self):
+        pass
+
+    def wait(self):
+        return self.returncode
+
+    def kill(self):
+        self._worker.cancel(self._idno)
+
+    def feed(self, data):
+        self._lines.put(data)
+
+    def exit(self, returncode):
+        if not self._acked.is_set():
+            self.ack("worker disconnected")
+        self.returncode = returncode
+        self._lines.put(b'')
+
+    # reason is None when worker started the task
+    def ack(self, reason=None):
+        self._rejected = reason
+        self._acked.set()
+
+    def wait_started(self, timeout):
+        if not self._acked.wait(timeout):
+            raise WorkerRejected("no reply in {}s".format(timeout))
+        if self._rejected:
+            raise WorkerRejected(self._rejected)
+
+
+class RemoteWorker():
+    def __init__(self, manager, conn, address):
+        self._manager = manager
+        self._conn = conn
+        self._stream = conn.makefile('rb')
+        self._send_lock = threading.Lock()
+        self._name = "{0}:{1}".format(address[0], address[1])
+        self._slots = 0
+        self._paths = []
+        self._processes = {}
+        self._accepted = False
+        self._thread = threading.Thread(target=self._reader, daemon=True)
+
+    def name(self):
+        return self._name
+
+    def start(self):
+        self._thread.start()
+
+    def free_slots(self):
+        return self._slots - len(self._processes)
+
+    def has_checkout(self, pwd):
+        for path in self._paths:
+            path = path.rstrip("/")
+            if pwd == path or pwd.startswith(path + "/"):
+                return True
+        return False
+
+    # run with task manager lock acquired
+    def reserve(self, idno):
+        self._processes[idno] = RemoteProcess(self, idno)
+
+    def release(self, idno):
+        process = self._processes.pop(idno, None)
+        if process:
+            process.exit(-1)
+
+    # Ask worker to start task, raises WorkerRejected when it didn't. Worker
+    # checks that it has the checkout at the same revision.
+    def dispatch(self, task):
+        process = self._processes.get(task.id())
+        if not process:
+            raise WorkerRejected("no slot reserved")
+        try:
+            send_message(self._conn, self._send_lock, type="run", id=task.id(), pwd=task.pwd(), argv=task.argv(),
+                         low=task.low_priority(), rev=checkout_revision(task.pwd()))
+        except OSError as e:
+            raise WorkerRejected(str(e))
+        process.wait_started(WORKER_ACK_TIMEOUT)
+
+    def spawn(self, task):
+        process = self._processes.get(task.id())
+        if not process:
+            raise OSError("No slot reserved for task {} in worker {}".format(task.id(), self._name))
+        return process
+
+    def cancel(self, idno):
+        try:
+            send_message(self._conn, self._send_lock, type="cancel", id=idno)
+        except OSError:
+            self.release(idno)
+
+    def _reader(self):
+        try:
+            for msg in read_messages(self._stream):
+                kind = msg.get("type")
+                if not self._accepted:
+                    if kind != "hello" or not self._manager.valid_worker_token(str(msg.get("token", ""))):
+                        self._manager.refuse_worker(self)
+                        break
+                    self._accepted = True
+                    self._slots = int(msg.get("slots", WORKER_SLOTS))
+                    self._paths = [str(p) for p in msg.get("paths", [])]
+                    self._manager.add_worker(self)
+                elif kind == "started":
+                    process = self._processes.get(msg.get("id"))
+                    if process:
+                        process.ack()
+                elif kind == "reject":
+                    process = self._processes.pop(msg.get("id"), None)
+                    if process:
+                        process.ack(str(msg.get("reason", "rejected")))
+                elif kind == "output":
+                    process = self._processes.get(msg.get("id"))
+                    if process:
+                        process.feed(msg.get("data", "").encode())
+                elif kind == "exit":
+                    process = self._processes.pop(msg.get("id"), None)
+                    if process:
+                        process.exit(int(msg.get("returncode", -1)))
+        except OSError:
+            pass
+        for idno in list(self._processes.keys()):
+            self.release(idno)
+        if self._accepted:
+            self._manager.remove_worker(self)
+        self._conn.close()
+
+
+class WorkerDaemon():
+    def __init__(self, address, token, slots=WORKER_SLOTS, paths=None):
+        self._address = address
+        self._token = token
+        self._slots = slots
+        self._paths = [os.path.abspath(p) for p in (paths or [str(Path.home())])]
+        self._conn = None
+        self._send_lock = threading.Lock()
+        self._processes = {}
+        self._cancelled = set()
+        self._processes_lock = threading.Lock()
+
+    def run(self):
+        while True:
+            try:
+                self._serve()
+            except OSError as e:
+                print("Connection to {0}:{1} failed: {2}".format(self._address[0], self._address[1], e))
+            self._kill_all()
+            time.sleep(WORKER_RETRY_DELAY)
+
+    def _serve(self):
+        conn = socket.create_connection(self._address)
+        self._conn = conn
+        print("Worker connected to {0}:{1}".format(self._address[0], self._address[1]))
+        self._send(conn, type="hello", token=self._token, slots=self._slots, paths=self._paths)
+        with conn.makefile('rb') as stream:
+            for msg in read_messages(stream):
+                kind = msg.get("type")
+                if kind == "run":
+                    threading.Thread(target=self._run_task, daemon=True,
+                                     args=(conn, msg["id"], msg["pwd"], niced_command(msg["argv"], msg.get("low", False)),
+                                           msg.get("rev"))).start()
+                elif kind == "cancel":
+                    self._kill(msg.get("id"))
+        self._conn = None
+        conn.close()
+
+    # messages of tasks started from a connection that has since been
+    # replaced are dropped
+    def _send(self, conn, **msg):
+        if conn is not self._conn:
+            return
+        try:
+            send_message(conn, self._send_lock, **msg)
+        except OSError:
+            pass
+
+    def _run_task(self, conn, idno, pwd, argv, rev):
+        if not os.path.isdir(pwd):
+            self._send(conn, type="reject", id=idno, reason="no checkout in {}".format(pwd))
+            return
+        if rev and checkout_revision(pwd) != rev:
+            self._send(conn, type="reject", id=idno, reason="checkout in {0} is not at {1}".format(pwd, rev[:12]))
+            return
+        try:
+            process = subprocess.Popen(argv, cwd=pwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True)
+        except OSError as e:
+            self._send(conn, type="reject", id=idno, reason=str(e))
+            return
+        self._send(conn, type="started", id=idno)
+
+        with self._processes_lock:
+            self._processes[idno] = process
+            if idno in self._cancelled:
+                self._cancelled.discard(idno)
+                process.kill()
+        for line in iter(process.stdout.readline, b''):
+            self._send(conn, type="output", id=idno, data=line.decode('utf-8', 'replace'))
+        process.wait()
+        process.stdout.close()
+        with self._processes_lock:
+            self._processes.pop(idno, None)
+        self._send(conn, type="exit", id=idno, returncode=process.returncode)
+
+    def _kill(self, idno):
+        with self._processes_lock:
+            process = self._processes.get(idno)
+            if process:
+                process.kill()
+            else:
+                self._cancelled.add(idno)
+
+    def _kill_all(self):
+        with self._processes_lock:
+            for process in self._processes.values():
+                process.kill()
+
+
+# Paths and filters of a watched task. Task to run is copied so that the
+# watch outlives the original task in history.
+class Watch():
+    global_id = 0
+
+    def __init__(self, task, paths, include, exclude, debounce):
+        Watch.global_id += 1
+        self.id = Watch.global_id
+        self.pwd = task.pwd()
+        self.argv = task.argv()
+        self.background = task.background()
+        self.priority = task.priority()
+        self.deploy = task.deploy_argv()
+        self.task_id = task.id()
+        self.paths = [os.path.abspath(os.path.join(self.pwd, p)) for p in paths]
+        self.include = include
+        self.exclude = exclude
+        self.debounce = debounce
+        self.triggers = 0
+        # debounce deadline and the latest change, None when nothing is due
+        self.deadline = None
+        self.changed = None
+        # change seen while task of the watch runs, handled after it
+        self.running = False
+        self.pending = None
+        self.ignore_until = 0
+
+    # Changes made while task of the watch runs are kept as pending and
+    # ignored for the debounce time after it so that its late output doesn't
+    # queue it again. Returns the pending change when the task stops.
+    def set_running(self, running):
+        self.running = running
+        if running:
+            self.pending = None
+            return None
+        self.ignore_until = time.monotonic() + self.debounce
+        pending, self.pending = self.pending, None
+        return pending
+
+    def cmdline(self):
+        return ' '.join(self.argv)
+
+    def root(self, path):
+        for p in self.paths:
+            if path == p or path.startswith(p + os.sep):
+                return p
+        return None
+
+    # path is matched against globs both as relative to the watched root
+    # and by each of its components
+    def _matches(self, rel, globs):
+        parts = rel.split(os.sep)
+        for g in globs:
+            if fnmatch.fnmatch(rel, g):
+                return True
+            for part in parts:
+                if fnmatch.fnmatch(part, g):
+                    return True
+        return False
+
+    def wanted(self, path, is_dir=False):
+        root = self.root(path)
+        if not root:
+            return False
+        rel = os.path.relpath(path, root)
+        if rel == ".":
+            return True
+        if self._matches(rel, self.exclude):
+            return False
+        if is_dir or not self.include:
+            return True
+        return self._matches(rel, self.include)
+
+
+# Single inotify instance watching directories of all watches recursively.
+# Bursts of changes are collapsed and callback(watch, path) is called from
+# the reader thread once things have been quiet for the debounce time.
+class SourceWatcher():
+    IN_MODIFY       = 0x00000002
+    IN_CLOSE_WRITE  = 0x00000008
+    IN_MOVED_FROM   = 0x00000040
+    IN_MOVED_TO     = 0x00000080
+    IN_CREATE       = 0x00000100
+    IN_DELETE       = 0x00000200
+    IN_DELETE_SELF  = 0x00000400
+    IN_IGNORED      = 0x00008000
+    IN_ISDIR        = 0x40000000
+    IN_CLOEXEC      = 0o2000000
+
+    MASK            = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+    TRIGGER         = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+    EVENT           = struct.Struct("iIII")
+
+    def __init__(self, callback):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(SourceWatcher.IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._callback = callback
+        self._watches = []
+        self._dirs = {}
+        self._lock = threading.Lock()
+        # wakes up reader when deadline is set from another thread
+        self._wake_read, self._wake_write = os.pipe()
+        self._thread = threading.Thread(target=self._reader, daemon=True)
+        self._thread.start()
+
+    def watches(self):
+        with self._lock:
+            return list(self._watches)
+
+    def add(self, watch):
+        with self._lock:
+            self._watches.append(watch)
+            for path in watch.paths:
+                self._add_tree(watch, path)
+
+    def remove(self, watch_id):
+        with self._lock:
+            for watch in self._watches:
+                if watch.id == watch_id:
+                    self._watches.remove(watch)
+                    self._prune()
+                    return True
+        return False
+
+    def clear(self):
+        with self._lock:
+            self._watches = []
+            self._prune()
+
+    # Change seen during the run is debounced once the task has stopped.
+    def set_running(self, watch, running):
+        with self._lock:
+            pending = watch.set_running(running)
+            if pending:
+                self._touch(watch, pending)
+                os.write(self._wake_write, b"\0")
+
+    # run with lock acquired, drop directories no longer under any watch
+    def _prune(self):
+        for wd, path in list(self._dirs.items()):
+            if not any(w.root(path) for w in self._watches):
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._dirs[wd]
+
+    # run with lock acquired
+    def _add_tree(self, watch, top):
+        for root, dirs, files in os.walk(top):
+            dirs[:] = [d for d in dirs if watch.wanted(os.path.join(root, d), True)]
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(root), SourceWatcher.MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                print("Cannot watch {0}: {1}".format(root, os.strerror(err)))
+                if err == errno.ENOSPC:
+                    # out of inotify watches, no point in trying further
+                    return
+                continue
+            self._dirs[wd] = root
+
+    def _reader(self):
+        while True:
+            try:
+                ready, _, _ = select.select([self._fd, self._wake_read], [], [], self._timeout())
+                if self._wake_read in ready:
+                    os.read(self._wake_read, 64)
+                data = os.read(self._fd, 64 * 1024) if self._fd in ready else b""
+            except (OSError, ValueError):
+                break
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, length = SourceWatcher.EVENT.unpack_from(data, pos)
+                pos += SourceWatcher.EVENT.size
+                name = data[pos:pos + length].rstrip(b"\0")
+                pos += length
+                self._event(wd, mask, os.fsdecode(name))
+            self._fire_due()
+
+    # seconds until the next debounce deadline, None when there is none
+    def _timeout(self):
+        with self._lock:
+            deadlines = [w.deadline for w in self._watches if w.deadline is not None]
+        if not deadlines:
+            return None
+        return max(0, min(deadlines) - time.monotonic())
+
+    def _fire_due(self):
+        now = time.monotonic()
+        due = []
+        with self._lock:
+            for watch in self._watches:
+                if watch.deadline is not None and watch.deadline <= now:
+                    watch.deadline = None
+                    due.append((watch, watch.changed))
+        for watch, path in due:
+            self._callback(watch, path)
+
+    def _event(self, wd, mask, name):
+        with self._lock:
+            if mask & SourceWatcher.IN_IGNORED:
+                self._dirs.pop(wd, None)
+                return
+            base = self._dirs.get(wd)
+            if base is None:
+                return
+            path = os.path.join(base, name) if name else base
+            is_dir = bool(mask & SourceWatcher.IN_ISDIR)
+            for watch in self._watches:
+                if not watch.wanted(path, is_dir):
+                    continue
+                if is_dir and mask & (SourceWatcher.IN_CREATE | SourceWatcher.IN_MOVED_TO):
+                    self._add_tree(watch, path)
+                if not mask & SourceWatcher.TRIGGER:
+                    continue
+                if watch.running:
+                    watch.pending = path
+                elif time.monotonic() >= watch.ignore_until:
+                    self._touch(watch, path)
+
+    # run with lock acquired, push debounce deadline of watch forward
+    def _touch(self, watch, path):
+        watch.deadline = time.monotonic() + watch.debounce
+        watch.changed = path
+
+    def close(self):
+        self.clear()
+        os.close(self._fd)
+        os.close(self._wake_write)
+        os.close(self._wake_read)
+
+
 class Task(threading.Thread):
     global_id = 0
 
@@ -117,19 +926,29 @@ class Task(threading.Thread):
     RUNNING     = 3
     DONE        = 4
     FAIL        = 5
+    STALLED     = 6
+
+    PRIORITY_HIGH   = 0
+    PRIORITY_NORMAL = 1
+    PRIORITY_LOW    = 2
 
     @staticmethod
     def reset_ids():
         Task.global_id = 0
 
-    def __init__(self, pwd, argv, state_callback=None, process_callback=None, background=False):
+    # idno is given when task is queued again with its old id
+    def __init__(self, pwd, argv, state_callback=None, process_callback=None, background=False, priority=PRIORITY_NORMAL, group=0, deploy=None, idno=None):
         threading.Thread.__init__(self)
         self._pwd = str(pwd)
         self._argv = [str(n) for n in argv]
-        Task.global_id += 1
-        self._id = Task.global_id
+        if idno is None:
+            Task.global_id += 1
+            idno = Task.global_id
+        self._id = idno
         self._state = Task.CREATED
         self._background = background
+        self._priority = priority
+        self._group = group or self._id
         self._process = None
         self._process_lock = threading.Lock()
         self._state_cb = state_callback
@@ -140,6 +959,29 @@ class Task(threading.Thread):
         self._followers = []
         self._output = []
         self._log_file = None
+        self._log_fn = None
+        self._log_index = None
+        self._log_offset = 0
+        self._log_header = 0
+        self._worker = None
+        self._rejected_by = set()
+        self._requeue_cb = None
+        self._last_activity = 0
+        self._last_output = 0
+        self._cpu_sample = None
+        self._stall_killed = False
+        self._diagnostics = {}
+        self._build = -1
+        self._deploy_argv = deploy
+        self._deploy_state = -1
+        self._deploy_cb = None
+        self._deploy_process = None
+        self._deploy_returncode = -1
+        self._deploy_timed_out = False
+        self._deploy_start = 0
+        self._deploy_duration = 0
+        self._deploy_rpms = []
+        self._rpms_before = {}
 
     def lock(self):
         self._process_lock.acquire();
@@ -153,6 +995,31 @@ class Task(threading.Thread):
     def set_process_callback(self, cb):
         self._process_cb = cb
 
+    def set_deploy_callback(self, cb):
+        self._deploy_cb = cb
+
+    def set_worker(self, worker):
+        self._worker = worker
+
+    def worker(self):
+        return self._worker
+
+    # called with the reason when worker refuses to start the task
+    def set_requeue_callback(self, cb):
+        self._requeue_cb = cb
+
+    def rejected_by(self):
+        return self._rejected_by
+
+    # Fresh task thread with the same id and settings for running the task
+    # again after worker refused it.
+    def requeued(self):
+        task = Task(self._pwd, self._argv, self._state_cb, None, self._background, self._priority, self._group, self._deploy_argv, self._id)
+        task.set_deploy_callback(self._deploy_cb)
+        task._rejected_by = self._rejected_by | {self._worker}
+        task._followers = self._followers
+        return task
+
     def id(self):
         return self._id
 
@@ -167,6 +1034,8 @@ class Task(threading.Thread):
 
     def state_pretty_str(self):
         s = LOG_STATE_STR.format(self.id(), self.pwd(), self.cmdline())
+        if self._worker:
+            s = "{0} @{1}".format(s, self._worker.name())
         if self._state > Task.STARTING:
             s = "{0} ({1:0>8})".format(s, str(timedelta(seconds=self.time())))
         return s
@@ -187,9 +1056,50 @@ class Task(threading.Thread):
     def background(self):
         return self._background
 
+    def priority(self):
+        return self._priority
+
+    def set_priority(self, priority):
+        self._priority = priority
+
+    # id of the first task in group, own id for tasks not in a group
+    def group(self):
+        return self._group
+
+    def prints_output(self):
+        return self._process_cb is not None
+
+    def builds_in_tree(self):
+        return os.path.basename(self._argv[0]) in IN_TREE_BUILD_CMDS
+
+    def low_priority(self):
+        return self._background or self._priority == Task.PRIORITY_LOW
+
+    # thread not started yet
+    def pending(self):
+        return self._state == Task.CREATED and self.ident is None
+
+    # thread started and task not finished
+    def active(self):
+        return self._state in (Task.CREATED, Task.STARTING, Task.RUNNING, Task.STALLED) and self.ident is not None
+
+    def running(self):
+        return self._state in (Task.RUNNING, Task.STALLED)
+
     def returncode(self):
         return self._returncode
 
+    def duration(self):
+        return self._duration
+
+    # thread has finished and nothing else will be done with the task
+    def finished(self):
+        if self._state not in (Task.DONE, Task.CANCEL, Task.FAIL):
+            return False
+        if self.ident is not None and self.is_alive():
+            return False
+        return self._deploy_state not in (Task.CREATED, Task.RUNNING)
+
     def time(self):
         if self._state == Task.DONE:
             return int(self._duration)
@@ -208,7 +1118,7 @@ class Task(threading.Thread):
         service = bus.get_object(name, PATH)
         method_write = service.get_dbus_method("Write", IFACE)
         method_quit = service.get_dbus_method("Quit", IFACE)
-        if self._state in (Task.CREATED, Task.STARTING, Task.RUNNING):
+        if self._state in (Task.CREATED, Task.STARTING, Task.RUNNING, Task.STALLED):
             self._followers.append((method_write, method_quit, name))
         else:
             GLib.idle_add(self._quit_follower, method_quit)
@@ -224,10 +1134,84 @@ class Task(threading.Thread):
     def log(self):
         return "".join(self._output)
 
-    def _process_line(self, line):
+    def _flush_log(self):
+        self.lock()
+        if self._log_file:
+            self._log_file.flush()
+            self._log_index.flush()
+        self.unlock()
+
+    def log_lines(self, start, count):
+        if self._log_fn:
+            self._flush_log()
+            return read_log_lines(self._log_fn, start, count)
+        start, end = line_range(len(self._output), start, count)
+        return "".join(self._output[start:end]), len(self._output)
+
+    # read only descriptor to the log positioned at the first output line
+    def log_fd(self):
+        if not self._log_fn:
+            return -1
+        self._flush_log()
+        fd = os.open(self._log_fn, os.O_RDONLY)
+        os.lseek(fd, self._log_header, os.SEEK_SET)
+        return fd
+
+    def log_path(self):
+        return self._log_fn
+
+    def log_header(self):
+        return self._log_header
+
+    def log_error_line(self):
+        if self._log_fn:
+            self._flush_log()
+            return first_error_line(self._log_fn)
+        for lineno, line in enumerate(self._output):
+            if is_error_line(line):
+                return lineno
+        return -1
+
+    def _log_line(self, line):
         self._output.append(line)
         if self._log_file:
-            self._log_file.write(line)
+            data = line.encode()
+            entry = self._log_offset
+            if is_error_line(line):
+                entry |= LOG_INDEX_ERROR
+            self._log_index.write(LOG_INDEX_ENTRY.pack(entry))
+            self._log_file.write(data)
+            self._log_offset += len(data)
+
+    # {(file, line, fingerprint): [kind, message, count]} seen in output
+    def diagnostics(self):
+        return self._diagnostics
+
+    # id of the build in diagnostics store, -1 when not recorded
+    def build(self):
+        return self._build
+
+    def set_build(self, build):
+        self._build = build
+
+    def _collect_diagnostic(self, line):
+        found = parse_diagnostic(self._pwd, line)
+        if not found:
+            return
+        key, kind, message = found
+        if key in self._diagnostics:
+            self._diagnostics[key][2] += 1
+        else:
+            self._diagnostics[key] = [kind, message, 1]
+
+    def _process_line(self, line):
+        self._collect_diagnostic(line)
+        self._last_output = time.time()
+        self._last_activity = self._last_output
+        self._cpu_sample = None
+        if self._state == Task.STALLED:
+            self._set_state(Task.RUNNING)
+        self._log_line(line)
 
         if len(self._followers):
             for method_write, method_quit, name in self._followers:
@@ -251,8 +1235,23 @@ class Task(threading.Thread):
 
     def run(self):
         if self._state != Task.CREATED:
+            if self._worker:
+                self._worker.release(self._id)
             return
 
+        if self._worker:
+            try:
+                self._worker.dispatch(self)
+            except WorkerRejected as e:
+                self._worker.release(self._id)
+                if self._state == Task.CREATED and self._requeue_cb:
+                    self._requeue_cb(self, str(e))
+                return
+            # cancelled while waiting for worker
+            if self._state != Task.CREATED:
+                self._worker.cancel(self._id)
+                return
+
         self._start_time = time.time()
 
         if BUILD_LOGS_ENABLED:
@@ -260,16 +1259,28 @@ class Task(threading.Thread):
             log_fn = os.path.join(str(log_path), "{0:s}-{1:s}.log".format(datetime.now().strftime("%Y.%m.%d-%H:%M:%S"), self.slugify()))
             if not log_path.exists():
                 log_path.mkdir()
-            self._log_file = open(log_fn, "w")
-            self._log_file.write("{0:s} $ {1:s}\n".format(self.pwd(), self.cmdline()))
-            self._log_file.write("================log================\n")
+            self._log_file = open(log_fn, "wb")
+            self._log_file.write("{0:s} $ {1:s}\n".format(self.pwd(), self.cmdline()).encode())
+            self._log_file.write("================log================\n".encode())
+            self._log_offset = self._log_file.tell()
+            self._log_header = self._log_offset
+            self._log_index = open(log_fn + LOG_INDEX_SUFFIX, "wb")
+            self._log_fn = log_fn
+
+        if self._deploy_argv is not None:
+            self._rpms_before = rpm_snapshot(find_rpms_dir(self._pwd))
 
         self.lock()
         self._set_state(Task.STARTING, lock=False)
         try:
-            self._process = subprocess.Popen(self._argv, cwd=self._pwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True)
+            if self._worker:
+                self._process = self._worker.spawn(self)
+            else:
+                self._process = subprocess.Popen(niced_command(self._argv, self.low_priority()), cwd=self._pwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True)
         except OSError as e:
             print(e)
+            if self._worker:
+                self._worker.release(self._id)
             self._process = None
             self._set_state(Task.FAIL, lock=False)
 
@@ -277,6 +1288,8 @@ class Task(threading.Thread):
             self.unlock()
             return
 
+        self._last_output = time.time()
+        self._last_activity = self._last_output
         self._set_state(Task.RUNNING, lock=False)
         self.unlock()
 
@@ -313,17 +1326,341 @@ class Task(threading.Thread):
         if self._process.stderr:
             self._process.stderr.close()
         self._process = None
+        if self._log_file:
+            self._log_file.close()
+            self._log_index.close()
         self._log_file = None
+        self._log_index = None
+        self.unlock()
+
+    def pid(self):
+        return getattr(self._process, "pid", None)
+
+    def idle_time(self, now):
+        return now - self._last_output
+
+    # Called from watchdog for task without output for a while with cpu time
+    # of its process tree, None when not known. Task is stalled when neither
+    # output nor cpu use has been seen in stall_timeout seconds. Returns
+    # True when task was killed.
+    def check_stall(self, now, cpu, stall_timeout, kill_timeout):
+        self.lock()
+        if not self.running() or not self._process:
+            self.unlock()
+            return False
+        if cpu is not None:
+            previous = self._cpu_sample
+            self._cpu_sample = cpu
+            if previous is None:
+                # first sample since last output, compare on next round
+                self.unlock()
+                return False
+            if cpu > previous:
+                self._last_activity = now
+        idle = now - self._last_activity
+        if idle >= stall_timeout and self._state == Task.RUNNING:
+            self._set_state(Task.STALLED, lock=False)
+        elif idle < stall_timeout and self._state == Task.STALLED:
+            self._set_state(Task.RUNNING, lock=False)
+        killed = False
+        if kill_timeout > 0 and idle >= kill_timeout and not self._stall_killed:
+            self._log_line("watchdog: no output or cpu use in {}s, killed\n".format(int(idle)))
+            if self.pid() and not self._worker:
+                kill_tree(self.pid())
+            else:
+                self._process.kill()
+            self._stall_killed = True
+            killed = True
+        self.unlock()
+        return killed
+
+    # Deploy stage, -1 for tasks without one. Uses task states, CREATED
+    # while waiting in the deploy lane.
+    def has_deploy(self):
+        return self._deploy_argv is not None
+
+    def deploy_argv(self):
+        return self._deploy_argv
+
+    def deploy_state(self):
+        return self._deploy_state
+
+    def deploy_returncode(self):
+        return self._deploy_returncode
+
+    def deploy_timed_out(self):
+        return self._deploy_timed_out
+
+    def deploy_time(self):
+        if self._deploy_state == Task.RUNNING:
+            return int(time.time() - self._deploy_start)
+        return int(self._deploy_duration)
+
+    def deploy_rpms(self):
+        return self._deploy_rpms
+
+    def _set_deploy_state(self, state):
+        self._deploy_state = state
+        if self._deploy_cb:
+            self._deploy_cb(self)
+
+    # called from state callback (task lock held)
+    def queue_deploy(self):
+        self._set_deploy_state(Task.CREATED)
+
+    # Run from deploy lane after the task has finished successfully. Output
+    # is appended to task log.
+    def deploy(self, timeout=DEPLOY_TIMEOUT):
+        self.lock()
+        if self._deploy_state != Task.CREATED:
+            self.unlock()
+            return
+        self._deploy_start = time.time()
+        rpms_dir = find_rpms_dir(self._pwd)
+        after = rpm_snapshot(rpms_dir)
+        self._deploy_rpms = sorted(os.path.join(rpms_dir, n) for n, v in after.items() if self._rpms_before.get(n) != v)
+        if self._worker or not self._deploy_rpms:
+            # packages of remote builds are not here to deploy
+            self._set_deploy_state(Task.CANCEL)
+            self.unlock()
+            return
+
+        if self._log_fn:
+            self._log_file = open(self._log_fn, "ab")
+            self._log_index = open(self._log_fn + LOG_INDEX_SUFFIX, "ab")
+        self._log_line("================deploy================\n")
+        env = dict(os.environ)
+        env["SDK_CHANGED_RPMS"] = " ".join(self._deploy_rpms)
+        env["SDK_NO_WATCH"] = "1"
+        argv = self._deploy_argv or DEPLOY_CMD
+        try:
+            # own process group so that children holding the output open are
+            # killed with it
+            self._deploy_process = subprocess.Popen(argv, cwd=self._pwd, env=env, stdin=subprocess.DEVNULL,
+                                                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True,
+                                                    start_new_session=True)
+        except OSError as e:
+            self._log_line("{}\n".format(e))
+            self._deploy_process = None
+        self._set_deploy_state(Task.RUNNING if self._deploy_process else Task.FAIL)
+        process = self._deploy_process
+        self.unlock()
+
+        if process:
+            timer = None
+            if timeout > 0:
+                timer = threading.Timer(timeout, self._deploy_timeout, [process, timeout])
+                timer.daemon = True
+                timer.start()
+            for line in iter(process.stdout.readline, b''):
+                self.lock()
+                self._log_line(line.decode('utf-8', 'replace'))
+                self.unlock()
+            process.wait()
+            process.stdout.close()
+            if timer:
+                timer.cancel()
+
+        self.lock()
+        self._deploy_duration = time.time() - self._deploy_start
+        self._deploy_process = None
+        if process:
+            self._deploy_returncode = process.returncode
+            if self._deploy_state == Task.RUNNING:
+                self._set_deploy_state(Task.DONE if process.returncode == 0 else Task.FAIL)
+        if self._log_file:
+            self._log_file.close()
+            self._log_index.close()
+        self._log_file = None
+        self._log_index = None
+        self.unlock()
+
+    # called from timer thread
+    def _deploy_timeout(self, process, timeout):
+        self.lock()
+        if self._deploy_process is process and self._deploy_state == Task.RUNNING:
+            self._deploy_timed_out = True
+            self._log_line("deploy killed after {}s\n".format(timeout))
+            kill_group(process)
         self.unlock()
 
     def cancel(self):
         self.lock()
+        if self._deploy_state in (Task.CREATED, Task.RUNNING):
+            if self._deploy_process:
+                kill_group(self._deploy_process)
+            self._set_deploy_state(Task.CANCEL)
         if self._process:
             self._process.kill()
-        if self._state in (Task.CREATED, Task.STARTING, Task.RUNNING):
+        if self._state in (Task.CREATED, Task.STARTING, Task.RUNNING, Task.STALLED):
             self._set_state(Task.CANCEL, lock=False)
         self.unlock()
 
+# Record of a finished task kept in history instead of the Task thread.
+# Output is read from the log file, it is kept in memory only when build
+# logs are disabled.
+class FinishedTask():
+    __slots__ = ("_id", "_state", "_pwd", "_argv", "_returncode", "_duration", "_log_fn", "_log_header",
+                 "_output", "_background", "_priority", "_deploy", "_deploy_result", "_build")
+
+    def __init__(self, task):
+        self._id = task.id()
+        self._state = task.state()
+        self._pwd = task.pwd()
+        self._argv = tuple(task.argv())
+        self._returncode = task.returncode()
+        self._duration = int(task.duration())
+        self._log_fn = task.log_path()
+        self._log_header = task.log_header()
+        self._output = None if self._log_fn else task.log()
+        self._background = task.background()
+        self._priority = task.priority()
+        self._deploy = task.deploy_argv()
+        self._deploy_result = None
+        if self._deploy is not None:
+            self._deploy_result = (task.deploy_state(), task.deploy_returncode(), task.deploy_time())
+        self._build = task.build()
+
+    def id(self):
+        return self._id
+
+    def state(self):
+        return self._state
+
+    def pwd(self):
+        return self._pwd
+
+    def argv(self):
+        return list(self._argv)
+
+    def cmdline(self):
+        return ' '.join(self._argv)
+
+    def returncode(self):
+        return self._returncode
+
+    def time(self):
+        if self._state == Task.CANCEL:
+            return -1
+        return self._duration
+
+    def background(self):
+        return self._background
+
+    def priority(self):
+        return self._priority
+
+    def group(self):
+        return self._id
+
+    def worker(self):
+        return None
+
+    def pending(self):
+        return False
+
+    def active(self):
+        return False
+
+    def finished(self):
+        return True
+
+    def has_deploy(self):
+        return self._deploy is not None
+
+    def deploy_argv(self):
+        return self._deploy
+
+    def build(self):
+        return self._build
+
+    def deploy_state(self):
+        return self._deploy_result[0] if self._deploy_result else -1
+
+    def deploy_returncode(self):
+        return self._deploy_result[1] if self._deploy_result else -1
+
+    def deploy_time(self):
+        return self._deploy_result[2] if self._deploy_result else 0
+
+    def register_follower(self, name):
+        bus = dbus.SessionBus()
+        service = bus.get_object(name, "/org/sailfish/sdk/client")
+        method_quit = service.get_dbus_method("Quit", "org.sailfish.sdk.client")
+        GLib.idle_add(method_quit, self._returncode)
+
+    def unregister_follower(self, name):
+        pass
+
+    def log(self):
+        if not self._log_fn:
+            return self._output
+        try:
+            with open(self._log_fn, "rb") as f:
+                f.seek(self._log_header)
+                return f.read().decode('utf-8', 'replace')
+        except OSError:
+            return ""
+
+    def log_lines(self, start, count):
+        if not self._log_fn:
+            lines = self._output.splitlines(True)
+            start, end = line_range(len(lines), start, count)
+            return "".join(lines[start:end]), len(lines)
+        return read_log_lines(self._log_fn, start, count)
+
+    def log_fd(self):
+        if not self._log_fn:
+            return -1
+        fd = os.open(self._log_fn, os.O_RDONLY)
+        os.lseek(fd, self._log_header, os.SEEK_SET)
+        return fd
+
+    def log_path(self):
+        return self._log_fn
+
+    def log_error_line(self):
+        if self._log_fn:
+            return first_error_line(self._log_fn)
+        for lineno, line in enumerate(self._output.splitlines(True)):
+            if is_error_line(line):
+                return lineno
+        return -1
+
+
+# Deploys are run one at a time in their own thread so that the next
+# build can start right after the previous one has finished.
+class DeployLane():
+    def __init__(self):
+        self._timeout = DEPLOY_TIMEOUT
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._handler, daemon=True)
+        self._thread.start()
+
+    def set_timeout(self, timeout):
+        self._timeout = timeout
+
+    def push(self, task):
+        task.queue_deploy()
+        self._queue.put(task)
+
+    def _handler(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                break
+            try:
+                # task is pushed from its DONE callback, its thread closes
+                # the log before deploy opens it again
+                task.join()
+                task.deploy(self._timeout)
+            except Exception:
+                traceback.print_exc()
+
+    def stop(self):
+        self._queue.put(None)
+
+
 class TaskManager():
     def __init__(self, service):
         self._tasks = []
@@ -331,8 +1668,209 @@ class TaskManager():
         self._service = service
         self._printer = WorkerPrinter()
         self._history_length = TASK_HISTORY_LENGTH
+        self._finishing = []
+        # lookups that stay cheap however long the history is
+        self._by_id = {}
+        self._running = set()
+        # local foreground tasks started and not finished, for scheduling
+        self._local = set()
+        self._latest = None
+        self._diagnostic_store = None
+        self._stall_timeout = STALL_TIMEOUT
+        self._stall_kill_timeout = STALL_KILL_TIMEOUT
+        self._watchdog_stop = threading.Event()
+        threading.Thread(target=self._watchdog, daemon=True).start()
+        self._workers = []
+        self._group_slots = GROUP_SLOTS
+        self._watcher = None
+        self._deploy_lane = DeployLane()
+        self._listener = None
+        self._worker_token = None
         signal.signal(signal.SIGINT, self._sigint_handler)
 
+    def listen(self, port, address=WORKER_ADDRESS, token_file=None):
+        token_file = token_file or os.path.join(str(Path.home()), WORKER_TOKEN_FILE)
+        self._worker_token = worker_token(token_file, create=True)
+        self._listener = socket.create_server((address, port))
+        threading.Thread(target=self._accept_workers, daemon=True).start()
+        self._printer.println("Waiting for workers in {0}:{1}, token in {2}".format(address, port, token_file))
+
+    def valid_worker_token(self, token):
+        return bool(self._worker_token) and hmac.compare_digest(token, self._worker_token)
+
+    # called from worker thread
+    def refuse_worker(self, worker):
+        self._printer.println(ERROR_STR.format("Worker {} refused, invalid token".format(worker.name())))
+
+    def _accept_workers(self):
+        while True:
+            try:
+                conn, address = self._listener.accept()
+            except OSError:
+                break
+            RemoteWorker(self, conn, address).start()
+
+    # called from worker thread
+    def add_worker(self, worker):
+        self._tasks_lock.acquire()
+        if worker not in self._workers:
+            self._workers.append(worker)
+        self._printer.println("Worker {0} connected ({1} slots)".format(worker.name(), worker.free_slots()))
+        self._schedule()
+        self._tasks_lock.release()
+
+    # called from worker thread
+    def remove_worker(self, worker):
+        self._tasks_lock.acquire()
+        if worker in self._workers:
+            self._workers.remove(worker)
+            self._printer.println("Worker {0} disconnected".format(worker.name()))
+        self._tasks_lock.release()
+
+    # run with task lock acquired
+    def _pick_worker(self, task):
+        best = None
+        for worker in self._workers:
+            if worker.free_slots() <= 0 or not worker.has_checkout(task.pwd()) or worker in task.rejected_by():
+                continue
+            if not best or worker.free_slots() > best.free_slots():
+                best = worker
+        return best
+
+    def _diagnostics(self):
+        if not self._diagnostic_store and BUILD_LOGS_ENABLED:
+            log_path = Path(os.path.join(str(Path.home()), BUILD_LOGS_PATH))
+            try:
+                if not log_path.exists():
+                    log_path.mkdir()
+                self._diagnostic_store = DiagnosticStore(os.path.join(str(log_path), DIAGNOSTICS_DB))
+            except (OSError, sqlite3.Error) as e:
+                self._printer.println(ERROR_STR.format("Cannot open diagnostics store: {}".format(e)))
+        return self._diagnostic_store
+
+    # called from task thread when it has finished
+    def _record_diagnostics(self, task):
+        store = self._diagnostics()
+        if not store:
+            return
+        try:
+            build, new, total = store.record(task.pwd(), task.id(), task.diagnostics())
+        except sqlite3.Error as e:
+            self._printer.println(ERROR_STR.format("Cannot store diagnostics: {}".format(e)))
+            return
+        task.set_build(build)
+        if total > 0:
+            self._printer.println(WARN_STR.format("({0}) {1} diagnostics, {2} new".format(task.id(), total, new)))
+
+    # (file, line, kind, message, builds seen in, hits, first seen, last seen,
+    # new) of diagnostics seen in latest build of task
+    def task_diagnostics(self, idno, new_only):
+        store = self._diagnostics()
+        if not store:
+            return []
+        task = self._latest if idno < 0 else self._task_with_id(idno)
+        if not task or task.build() < 0:
+            return []
+        return store.query(task.build(), new_only)
+
+    def set_stall_timeouts(self, stall, kill):
+        self._stall_timeout = stall
+        self._stall_kill_timeout = kill
+
+    def _watchdog(self):
+        while not self._watchdog_stop.wait(STALL_CHECK_INTERVAL):
+            if self._stall_timeout > 0 or self._stall_kill_timeout > 0:
+                self._check_stalled()
+
+    # Cpu use of process trees is only looked at for tasks that have been
+    # quiet for long enough.
+    def _check_stalled(self):
+        now = time.time()
+        limit = min(t for t in (self._stall_timeout, self._stall_kill_timeout) if t > 0)
+        self._tasks_lock.acquire()
+        quiet = [t for t in list(self._running) if t.running() and t.idle_time(now) >= limit]
+        self._tasks_lock.release()
+        if not quiet:
+            return
+        cpu = tree_cpu_times([t.pid() for t in quiet if t.pid()])
+        stall = self._stall_timeout if self._stall_timeout > 0 else self._stall_kill_timeout
+        for task in quiet:
+            if task.check_stall(now, cpu.get(task.pid()), stall, self._stall_kill_timeout):
+                self._printer.println(ERROR_STR.format("({0}) killed by watchdog after {1}s without progress".format(task.id(), self._stall_kill_timeout)))
+
+    def set_history_length(self, length):
+        self._history_length = max(1, length)
+
+    def set_group_slots(self, slots):
+        self._group_slots = max(1, slots)
+
+    def set_deploy_timeout(self, timeout):
+        self._deploy_lane.set_timeout(timeout)
+
+    # run with task lock acquired, returns local foreground tasks running
+    def _local_active(self):
+        return list(self._local)
+
+    # run with task lock acquired
+    def _local_busy(self):
+        return len(self._local) > 0
+
+    # run with task lock acquired, task can run next to the active local
+    # tasks if they all belong to its group, there are group slots left and
+    # none of them builds in the same source tree
+    def _group_slot_free(self, task):
+        active = self._local_active()
+        if len(active) >= self._group_slots:
+            return False
+        for t in active:
+            if t.group() != task.group():
+                return False
+            if t.pwd() == task.pwd() and (t.builds_in_tree() or task.builds_in_tree()):
+                return False
+        return True
+
+    # run with task lock acquired, replace tasks that are done with all
+    # they are doing with compact records
+    def _archive_finished(self):
+        still = []
+        for task in self._finishing:
+            if not task.finished():
+                still.append(task)
+                continue
+            try:
+                record = FinishedTask(task)
+                self._tasks[self._tasks.index(task)] = record
+                self._by_id[record.id()] = record
+                if self._latest is task:
+                    self._latest = record
+            except ValueError:
+                # already dropped from history
+                pass
+        self._finishing = still
+
+    # run with task lock acquired
+    def _schedule(self):
+        self._archive_finished()
+        for task in self._tasks:
+            if not task.pending():
+                continue
+            if not self._local_busy():
+                self._run_task(task)
+                continue
+            if self._group_slot_free(task):
+                # only the first task of concurrent ones prints its output
+                task.set_process_callback(None)
+                self._run_task(task)
+                continue
+            worker = self._pick_worker(task)
+            if worker:
+                worker.reserve(task.id())
+                task.set_worker(worker)
+                task.set_process_callback(None)
+                task.set_requeue_callback(self._task_rejected)
+                if not self._run_task(task):
+                    worker.release(task.id())
+
     def tasks(self):
         ret = []
         self._tasks_lock.acquire()
@@ -341,93 +1879,269 @@ class TaskManager():
         self._tasks_lock.release()
         return ret
 
-    def task(self, idno):
-        ret = None
+    # Tasks in queue order filtered by states (empty for any), background
+    # (< 0 for any), pwd prefix and id greater than after_id, limited to
+    # newest tasks when newest > 0.
+    # newest are the last matching tasks in queue order, history is walked
+    # from the end and only until that many have been found
+    def query_tasks(self, states, background, pwd_prefix, after_id, newest):
         self._tasks_lock.acquire()
-        for i in self._tasks:
-            if i.id() == idno:
-                ret = (i.id(), i.state(), i.pwd(), i.cmdline(), i.returncode(), i.time())
+        found = []
+        for i in (reversed(self._tasks) if newest > 0 else self._tasks):
+            if i.id() <= after_id:
+                continue
+            if states and i.state() not in states:
+                continue
+            if background >= 0 and i.background() != bool(background):
+                continue
+            if pwd_prefix and not i.pwd().startswith(pwd_prefix):
+                continue
+            found.append(i)
+            if len(found) == newest:
                 break
+        if newest > 0:
+            found.reverse()
+        ret = [(i.id(), i.state(), i.pwd(), i.cmdline(), i.returncode(), i.time()) for i in found]
         self._tasks_lock.release()
         return ret
 
-    # run with task lock acquired
+    def task(self, idno):
+        i = self._by_id.get(idno)
+        if i:
+            return (i.id(), i.state(), i.pwd(), i.cmdline(), i.returncode(), i.time())
+        return None
+
+    def latest_task_id(self):
+        if self._latest:
+            return self._latest.id()
+        return -1
+
+    # ids of running (and stalled) tasks, newest first
+    def running_task_ids(self):
+        return sorted((t.id() for t in list(self._running)), reverse=True)
+
+    # run with task lock acquired, queued tasks are kept ordered by priority
     def _append_task(self, task):
         if len(self._tasks) >= self._history_length:
-            i = 0
-            for t in self._tasks:
+            for i, t in enumerate(self._tasks):
                 if t.state() in (Task.DONE, Task.CANCEL, Task.FAIL):
-                    self._tasks.pop(i)
+                    self._by_id.pop(self._tasks.pop(i).id(), None)
                     break
-            i += 1
-        self._tasks.append(task)
+        index = len(self._tasks)
+        if task.pending():
+            for i, t in enumerate(self._tasks):
+                if t.pending() and t.priority() > task.priority():
+                    index = i
+                    break
+        self._tasks.insert(index, task)
+        self._by_id[task.id()] = task
+        self._latest = task
 
     def _run_task(self, task):
         try:
+            if not task.background() and not task.worker():
+                self._local.add(task)
             task.start()
             return True
         except Exception as e:
+            self._local.discard(task)
             self._printer.println("[\x1b[32m{}\x1b[39m] {}  \x1b[31mFailed to create task thread: {}\x1b[39m".format(task.pwd(), task.cmdline(), e))
             self._printer.println(traceback.format_exc())
             return False
 
 
-    def add_task(self, pwd, cmdline, background):
+    # called from task thread when worker did not start it, task is replaced
+    # in queue by a new thread with the same id
+    def _task_rejected(self, task, reason):
+        self._tasks_lock.acquire()
+        self._printer.println(WARN_STR.format("({0}) not run in worker {1}: {2}, queued again".format(task.id(), task.worker().name(), reason)))
+        try:
+            again = task.requeued()
+            if not again.background():
+                again.set_process_callback(self._task_process_line)
+            self._tasks[self._tasks.index(task)] = again
+            self._by_id[again.id()] = again
+            if self._latest is task:
+                self._latest = again
+            self._schedule()
+        except ValueError:
+            # dropped from history meanwhile
+            pass
+        self._tasks_lock.release()
+
+    # deploy is command run after success when packages changed, empty list
+    # uses DEPLOY_CMD and None means no deploy stage
+    def add_task(self, pwd, cmdline, background, priority=Task.PRIORITY_NORMAL, deploy=None):
         self._tasks_lock.acquire()
         #if len(self._tasks) == 0:
         #    Task.reset_ids()
         cb = None
         if not background:
             cb = self._task_process_line
-        task = Task(pwd, cmdline, self._task_state_changed, cb, background)
-        if background or not self._find_task(Task.RUNNING):
-            if not self._run_task(task):
-                self._tasks_lock.release()
-                return -1
+        task = Task(pwd, cmdline, self._task_state_changed, cb, background, priority, deploy=deploy)
+        task.set_deploy_callback(self._task_deploy_changed)
+        if background and not self._run_task(task):
+            self._tasks_lock.release()
+            return -1
         self._append_task(task)
+        if not background:
+            self._schedule()
         self._tasks_lock.release()
 
         self._printer.debug("({0}) {1}task added".format(task.id(), "background " if task.background() else ""))
         self._service.TaskStateChanged(task.state(), task.id(), task.pwd(), task.cmdline(), task.time())
         return task.id()
 
+    # Add the same kind of task for multiple command lines, for example one
+    # for every target. Tasks of the group may run concurrently within the
+    # group slots. Returns ids of the created tasks.
+    def add_task_group(self, pwd, cmdlines, priority=Task.PRIORITY_NORMAL):
+        tasks = []
+        self._tasks_lock.acquire()
+        group = 0
+        for cmdline in cmdlines:
+            task = Task(pwd, cmdline, self._task_state_changed, self._task_process_line, False, priority, group)
+            group = task.group()
+            self._append_task(task)
+            tasks.append(task)
+        self._schedule()
+        self._tasks_lock.release()
+
+        for task in tasks:
+            self._printer.debug("({0}) task added to group {1}".format(task.id(), task.group()))
+            self._service.TaskStateChanged(task.state(), task.id(), task.pwd(), task.cmdline(), task.time())
+        return [task.id() for task in tasks]
+
     def repeat_task(self, idno):
         task = None
         pwd = None
         argv = None
         background = False
+        priority = Task.PRIORITY_NORMAL
+        deploy = None
         self._tasks_lock.acquire()
         if idno < 0:
-            task = self._tasks[-1]
+            task = self._latest
         else:
-            for t in self._tasks:
-                if t.id() == idno:
-                    task = t
-                    break
+            task = self._task_with_id(idno)
         if task:
             pwd = task.pwd()
             argv = task.argv()
             background = task.background()
+            priority = task.priority()
+            deploy = task.deploy_argv()
         self._tasks_lock.release()
 
         if not pwd:
             return -1
-        return self.add_task(pwd, argv, background)
+        return self.add_task(pwd, argv, background, priority, deploy)
+
+    # Move queued task towards (delta < 0) or away from the queue head. Moving
+    # past a task of different priority changes the priority as well.
+    def move_task(self, idno, delta):
+        self._tasks_lock.acquire()
+        queued = [t for t in self._tasks if t.pending()]
+        task = self._task_with_id(idno)
+        moved = False
+        if task in queued:
+            pos = queued.index(task) + delta
+            if pos >= 0 and pos < len(queued):
+                other = queued[pos]
+                a = self._tasks.index(task)
+                b = self._tasks.index(other)
+                self._tasks[a], self._tasks[b] = other, task
+                task.set_priority(other.priority())
+                moved = True
+        self._tasks_lock.release()
+
+        if moved:
+            self._service.TaskStateChanged(task.state(), task.id(), task.pwd(), task.cmdline(), task.time())
+        return moved
+
+    # Queue task again whenever files under paths change. Relative paths are
+    # relative to task directory, no paths watches the task directory.
+    def watch_task(self, idno, paths, include, exclude, debounce=WATCH_DEBOUNCE):
+        self._tasks_lock.acquire()
+        if idno < 0:
+            task = self._latest
+        else:
+            task = self._task_with_id(idno)
+        self._tasks_lock.release()
+        if not task:
+            return -1
+
+        watch = Watch(task, paths or ["."], include, WATCH_EXCLUDE + exclude, debounce)
+        watch.set_running(task.state() not in (Task.DONE, Task.FAIL, Task.CANCEL))
+        try:
+            if not self._watcher:
+                self._watcher = SourceWatcher(self._watch_triggered)
+            self._watcher.add(watch)
+        except OSError as e:
+            self._printer.println(ERROR_STR.format("Cannot watch: {}".format(e)))
+            return -1
+        self._printer.println("Watching {0} for ({1}) {2}".format(", ".join(watch.paths), task.id(), task.cmdline()))
+        return watch.id
+
+    def unwatch_task(self, watch_id):
+        if self._watcher:
+            return self._watcher.remove(watch_id)
+        return False
+
+    def watches(self):
+        if not self._watcher:
+            return []
+        return [(w.id, w.task_id, w.pwd, w.cmdline(), w.paths, w.triggers) for w in self._watcher.watches()]
+
+    # called from watcher thread. Change to a task that hasn't started yet
+    # is picked up when it does, otherwise the task is queued again. Changes
+    # made during the new run queue it again after it has finished.
+    def _watch_triggered(self, watch, path):
+        self._tasks_lock.acquire()
+        task = self._task_with_id(watch.task_id)
+        if task and task.pending():
+            self._tasks_lock.release()
+            return
+        self._tasks_lock.release()
+
+        self._printer.println(WARN_STR.format("Changed {0}, queuing ({1}) {2} again".format(path, watch.id, watch.cmdline())))
+        self._watcher.set_running(watch, True)
+        idno = self.add_task(watch.pwd, watch.argv, watch.background, watch.priority, watch.deploy)
+        if idno < 0:
+            self._watcher.set_running(watch, False)
+            return
+        watch.task_id = idno
+        watch.triggers += 1
+        # it may have finished before the task id was set
+        self._tasks_lock.acquire()
+        task = self._task_with_id(idno)
+        finished = not task or task.state() in (Task.DONE, Task.FAIL, Task.CANCEL)
+        self._tasks_lock.release()
+        if finished:
+            self._watcher.set_running(watch, False)
+
+    # called from task state callback
+    def _watched_task_finished(self, task):
+        if not self._watcher:
+            return
+        for watch in self._watcher.watches():
+            if watch.task_id == task.id():
+                self._watcher.set_running(watch, False)
 
     def cancel_task(self, idno):
         self._tasks_lock.acquire()
-        for task in self._tasks:
-            if task.id() == idno:
-                task.cancel()
-                break
+        task = self._task_with_id(idno)
+        if task and not isinstance(task, FinishedTask):
+            task.cancel()
         self._tasks_lock.release()
 
     def cancel_all(self, clear_history=False):
         self._tasks_lock.acquire()
         running = None
         for task in self._tasks:
+            if isinstance(task, FinishedTask):
+                continue
             task.lock()
-            if task.state() == Task.RUNNING:
+            if task.running():
                 running = task
             task.unlock()
             if task != running:
@@ -438,14 +2152,18 @@ class TaskManager():
         if running:
             running.join()
         if clear_history:
+            if self._watcher:
+                self._watcher.clear()
             while len(self._tasks):
                 self._tasks.pop()
+            self._finishing = []
+            self._by_id.clear()
+            self._running.clear()
+            self._local.clear()
+            self._latest = None
 
     def _task_with_id(self, idno):
-        for task in self._tasks:
-            if task.id() == idno:
-                return task
-        return None
+        return self._by_id.get(idno)
 
     def follow_task(self, idno, name):
         task = self._task_with_id(idno)
@@ -465,8 +2183,53 @@ class TaskManager():
             return True, task.log()
         return False, ""
 
+    def task_log_lines(self, idno, start, count):
+        task = self._task_with_id(idno)
+        if task:
+            text, total = task.log_lines(start, count)
+            return True, text, total
+        return False, "", 0
+
+    def task_log_fd(self, idno):
+        task = self._task_with_id(idno)
+        if task:
+            try:
+                return task.log_fd()
+            except OSError:
+                pass
+        return -1
+
+    def task_log_path(self, idno):
+        task = self._task_with_id(idno)
+        if task and task.log_path() and task.state() in (Task.DONE, Task.CANCEL, Task.FAIL):
+            return True, task.log_path()
+        return False, ""
+
+    def task_log_error_line(self, idno):
+        task = self._task_with_id(idno)
+        if task:
+            return task.log_error_line()
+        return -1
+
+    def deploys(self):
+        ret = []
+        self._tasks_lock.acquire()
+        for i in self._tasks:
+            if i.has_deploy():
+                ret.append((i.id(), i.deploy_state(), i.deploy_returncode(), i.deploy_time()))
+        self._tasks_lock.release()
+        return ret
+
     def quit(self):
+        self._watchdog_stop.set()
+        if self._listener:
+            self._listener.close()
+        if self._watcher:
+            self._watcher.close()
+        self._deploy_lane.stop()
         self.cancel_all()
+        if self._diagnostic_store:
+            self._diagnostic_store.close()
         self._printer.done()
 
     # called from task thread
@@ -485,47 +2248,94 @@ class TaskManager():
         self._printer.println(line)
         if last:
             self._printer.end()
-        if not self._find_task(Task.RUNNING):
-            task = self._find_task(Task.CREATED)
-            if task:
-                self._run_task(task)
+        self._finishing.append(task)
+        self._schedule()
 
     # called from task thread (task lock held)
     def _task_state_changed(self, task):
         if self._printer.debug_enabled():
             self._printer.debug("({0}) task \"{1}\" state {2}".format(task.id(), task.cmdline(), task.state()))
 
+        if task.running():
+            self._running.add(task)
+        else:
+            self._running.discard(task)
+        if task.state() in (Task.DONE, Task.FAIL, Task.CANCEL):
+            self._local.discard(task)
+
         if task.state() == Task.STARTING:
-            self._printer.reset()
+            if task.prints_output():
+                self._printer.reset()
             self._printer.println(task.state_pretty_str())
 
+        elif task.state() == Task.STALLED:
+            self._printer.println(WARN_STR.format("({0}) STALLED, no output or cpu use in {1}s".format(task.id(), int(task.idle_time(time.time())))))
+
         elif task.state() == Task.CANCEL:
             # Cancel state is reached with _tasks_lock acquired
             self._print_and_remove(task, "{0}  {1}".format(task.state_pretty_str(), LOG_CANCEL_STR));
 
         elif task.state() == Task.DONE:
+            self._record_diagnostics(task)
             self._tasks_lock.acquire()
             self._print_and_remove(task, "{0}  {1}".format(task.state_pretty_str(), LOG_SUCCESS_STR));
             self._tasks_lock.release()
+            if task.has_deploy():
+                self._deploy_lane.push(task)
 
         elif task.state() == Task.FAIL:
+            self._record_diagnostics(task)
             self._tasks_lock.acquire()
-            self._print_and_remove(task, "{0}  {1} ({2})".format(task.state_pretty_str(), LOG_FAIL_STR, task.returncode()), last=True);
+            self._print_and_remove(task, "{0}  {1} ({2})".format(task.state_pretty_str(), LOG_FAIL_STR, task.returncode()), last=task.prints_output());
             self._tasks_lock.release()
 
+        if task.state() in (Task.DONE, Task.FAIL, Task.CANCEL):
+            self._watched_task_finished(task)
+
         self._service.TaskStateChanged(task.state(), task.id(), task.pwd(), task.cmdline(), task.time())
 
+    # called from deploy lane (task lock held)
+    def _task_deploy_changed(self, task):
+        state = task.deploy_state()
+        prefix = LOG_STATE_STR.format(task.id(), task.pwd(), "deploy")
+        if state == Task.RUNNING:
+            self._printer.println("{0} {1} changed packages".format(prefix, len(task.deploy_rpms())))
+        elif state == Task.DONE:
+            self._printer.println("{0} ({1:0>8})  {2}".format(prefix, str(timedelta(seconds=task.deploy_time())), LOG_SUCCESS_STR))
+        elif state == Task.FAIL and task.deploy_timed_out():
+            self._printer.println("{0} ({1:0>8})  {2} (timed out)".format(prefix, str(timedelta(seconds=task.deploy_time())), LOG_FAIL_STR))
+        elif state == Task.FAIL:
+            self._printer.println("{0} ({1:0>8})  {2} ({3})".format(prefix, str(timedelta(seconds=task.deploy_time())), LOG_FAIL_STR, task.deploy_returncode()))
+        elif state == Task.CANCEL:
+            reason = "no changed packages" if not task.deploy_rpms() else LOG_CANCEL_STR
+            self._printer.println("{0}  {1}".format(prefix, reason))
+        self._service.TaskDeployStateChanged(state, task.id(), task.pwd(), task.cmdline(), task.deploy_time())
+
     # Gobble ctrl+c so that it doesn't kill us but trickles down to the subprocess
     # we are running
     def _sigint_handler(self, sig, frame):
         pass
 
 
+class InvalidPriority(dbus.exceptions.DBusException):
+    _dbus_error_name = SERVICE_NAME + ".InvalidPriority"
+
+
+def check_priority(priority):
+    if priority not in (Task.PRIORITY_HIGH, Task.PRIORITY_NORMAL, Task.PRIORITY_LOW):
+        raise InvalidPriority("Unknown priority {}".format(priority))
+
+
 class Service(dbus.service.Object):
-    def __init__(self):
+    def __init__(self, group_slots=GROUP_SLOTS, history_length=TASK_HISTORY_LENGTH, stall_timeout=STALL_TIMEOUT, stall_kill_timeout=STALL_KILL_TIMEOUT,
+                 deploy_timeout=DEPLOY_TIMEOUT):
         self._manager = TaskManager(self)
+        self._manager.set_stall_timeouts(stall_timeout, stall_kill_timeout)
+        self._manager.set_deploy_timeout(deploy_timeout)
+        self._manager.set_group_slots(group_slots)
+        self._manager.set_history_length(history_length)
 
-    def run(self):
+    def run(self, listen_port=None, listen_address=WORKER_ADDRESS, token_file=None):
         dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
         bus_name = dbus.service.BusName(SERVICE_NAME, dbus.SessionBus())
         dbus.service.Object.__init__(self, bus_name, SERVICE_PATH)
@@ -534,6 +2344,8 @@ class Service(dbus.service.Object):
         # creating the MainLoop with new(None, False) disables the signal
         # handler so we can handle the signal later
         self._loop = GLib.MainLoop.new(None, False)
+        if listen_port:
+            self._manager.listen(listen_port, listen_address, token_file)
         print("Service running...")
         self._loop.run()
         self._manager.quit()
@@ -550,12 +2362,74 @@ class Service(dbus.service.Object):
     def Tasks(self):
         return self._manager.tasks()
 
+    # states empty for any state, background -1 for any, 0 or 1, newest 0
+    # for all
+    @dbus.service.method(SERVICE_NAME, in_signature='aiisii', out_signature='a(iissii)')
+    def QueryTasks(self, states, background, pwd_prefix, after_id, newest):
+        return self._manager.query_tasks(set(int(s) for s in states), background, str(pwd_prefix), after_id, newest)
+
+    # -1 when there are no tasks
+    @dbus.service.method(SERVICE_NAME, in_signature='', out_signature='i')
+    def LatestTaskId(self):
+        return self._manager.latest_task_id()
+
+    @dbus.service.method(SERVICE_NAME, in_signature='', out_signature='ai')
+    def RunningTaskIds(self):
+        return self._manager.running_task_ids()
+
     @dbus.service.method(SERVICE_NAME, in_signature='sasb', out_signature='i')
     def AddTask(self, pwd, cmdline, background):
         if len(cmdline) > 0:
             return self._manager.add_task(pwd, cmdline, background)
         return -1
 
+    @dbus.service.method(SERVICE_NAME, in_signature='sasbi', out_signature='i')
+    def AddTaskPriority(self, pwd, cmdline, background, priority):
+        check_priority(priority)
+        if len(cmdline) > 0:
+            return self._manager.add_task(pwd, cmdline, background, priority)
+        return -1
+
+    # Empty deploy runs the default deploy command after success.
+    @dbus.service.method(SERVICE_NAME, in_signature='sasbias', out_signature='i')
+    def AddTaskDeploy(self, pwd, cmdline, background, priority, deploy):
+        check_priority(priority)
+        if len(cmdline) > 0:
+            return self._manager.add_task(pwd, cmdline, background, priority, [str(a) for a in deploy])
+        return -1
+
+    # (task id, deploy state, return code, duration) of tasks with deploy stage
+    @dbus.service.method(SERVICE_NAME, in_signature='', out_signature='a(iiii)')
+    def Deploys(self):
+        return self._manager.deploys()
+
+    @dbus.service.method(SERVICE_NAME, in_signature='saasi', out_signature='ai')
+    def AddTaskGroup(self, pwd, cmdlines, priority):
+        check_priority(priority)
+        cmdlines = [c for c in cmdlines if len(c) > 0]
+        if len(cmdlines) > 0:
+            return self._manager.add_task_group(pwd, cmdlines, priority)
+        return []
+
+    @dbus.service.method(SERVICE_NAME, in_signature='ii', out_signature='b')
+    def MoveTask(self, idno, delta):
+        return self._manager.move_task(idno, delta)
+
+    # Empty paths watches task directory, debounce <= 0 uses default.
+    # Returns watch id or -1.
+    @dbus.service.method(SERVICE_NAME, in_signature='iasasasi', out_signature='i')
+    def WatchTask(self, idno, paths, include, exclude, debounce_ms):
+        debounce = debounce_ms / 1000.0 if debounce_ms > 0 else WATCH_DEBOUNCE
+        return self._manager.watch_task(idno, [str(p) for p in paths], [str(g) for g in include], [str(g) for g in exclude], debounce)
+
+    @dbus.service.method(SERVICE_NAME, in_signature='i', out_signature='b')
+    def UnwatchTask(self, watch_id):
+        return self._manager.unwatch_task(watch_id)
+
+    @dbus.service.method(SERVICE_NAME, in_signature='', out_signature='a(iissasi)')
+    def Watches(self):
+        return self._manager.watches()
+
     @dbus.service.method(SERVICE_NAME, in_signature='', out_signature='i')
     def Repeat(self, idno):
         return self._manager.repeat_task(idno)
@@ -587,6 +2461,38 @@ class Service(dbus.service.Object):
     def Log(self, idno):
         return self._manager.task_log(idno)
 
+    # start < 0 counts from end, count <= 0 reads to end
+    @dbus.service.method(SERVICE_NAME, in_signature='iii', out_signature='bsi')
+    def LogLines(self, idno, start, count):
+        return self._manager.task_log_lines(idno, start, count)
+
+    # Empty array when task has no log file. Caller gets its own descriptor,
+    # ours is closed after it has been duplicated to the message.
+    @dbus.service.method(SERVICE_NAME, in_signature='i', out_signature='ah')
+    def LogFd(self, idno):
+        fd = self._manager.task_log_fd(idno)
+        if fd < 0:
+            return []
+        try:
+            return [dbus.types.UnixFd(fd)]
+        finally:
+            os.close(fd)
+
+    # Log file of finished task, including the two line header.
+    @dbus.service.method(SERVICE_NAME, in_signature='i', out_signature='bs')
+    def LogPath(self, idno):
+        return self._manager.task_log_path(idno)
+
+    @dbus.service.method(SERVICE_NAME, in_signature='i', out_signature='i')
+    def LogErrorLine(self, idno):
+        return self._manager.task_log_error_line(idno)
+
+    # Diagnostics of the build of task, idno < 0 for latest task. With
+    # new_only only those that were not seen in earlier builds.
+    @dbus.service.method(SERVICE_NAME, in_signature='ib', out_signature='a(sissiiiib)')
+    def Diagnostics(self, idno, new_only):
+        return [(f, l, k, m, b, h, fs, ls, bool(n)) for f, l, k, m, b, h, fs, ls, n in self._manager.task_diagnostics(idno, new_only)]
+
     @dbus.service.method(SERVICE_NAME, in_signature='', out_signature='')
     def Quit(self):
         self._manager.cancel_all()
@@ -600,5 +2506,55 @@ class Service(dbus.service.Object):
     def TaskStateChanged(self, new_state, task_id, task_pwd, task_cmd, duration):
         pass
 
+    @dbus.service.signal(SERVICE_NAME)
+    def TaskDeployStateChanged(self, new_state, task_id, task_pwd, task_cmd, duration):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description="Run sdk tasks received over D-Bus.")
+    parser.add_argument("--listen", metavar="PORT", type=int, nargs="?", const=WORKER_PORT, default=None,
+                        help="accept worker daemons in PORT (default {})".format(WORKER_PORT))
+    parser.add_argument("--listen-address", metavar="ADDR", default=WORKER_ADDRESS,
+                        help="address to accept worker daemons in, \"\" for all (default {})".format(WORKER_ADDRESS))
+    parser.add_argument("--token-file", metavar="FILE", default=None,
+                        help="file with the token shared by coordinator and workers (default ~/{})".format(WORKER_TOKEN_FILE))
+    parser.add_argument("--worker", metavar="HOST[:PORT]", default=None,
+                        help="run as worker daemon for coordinator in HOST")
+    parser.add_argument("--slots", type=int, default=WORKER_SLOTS,
+                        help="number of tasks run concurrently in worker mode")
+    parser.add_argument("--history", type=int, default=TASK_HISTORY_LENGTH,
+                        help="number of tasks kept in history (default {})".format(TASK_HISTORY_LENGTH))
+    parser.add_argument("--stall-timeout", metavar="SECS", type=int, default=STALL_TIMEOUT,
+                        help="mark task stalled after SECS without output or cpu use, 0 disables (default {})".format(STALL_TIMEOUT))
+    parser.add_argument("--stall-kill", metavar="SECS", type=int, default=STALL_KILL_TIMEOUT,
+                        help="kill task after SECS without output or cpu use, 0 disables (default)")
+    parser.add_argument("--deploy-cmd", metavar="CMD", default=None,
+                        help="command run for tasks with deploy stage (default {})".format(" ".join(DEPLOY_CMD)))
+    parser.add_argument("--deploy-timeout", metavar="SECS", type=int, default=DEPLOY_TIMEOUT,
+                        help="kill deploy stage after SECS, 0 disables (default {})".format(DEPLOY_TIMEOUT))
+    parser.add_argument("--group-slots", type=int, default=GROUP_SLOTS,
+                        help="number of tasks of one group run concurrently locally, builds in the same directory "
+                             "are always run one at a time (default {})".format(GROUP_SLOTS))
+    parser.add_argument("--path", metavar="DIR", action="append", dest="paths", default=None,
+                        help="checkout root available in this worker, can be given multiple times (default home)")
+    args = parser.parse_args()
+
+    if args.deploy_cmd:
+        DEPLOY_CMD[:] = shlex.split(args.deploy_cmd)
+
+    if args.worker:
+        host, _, port = args.worker.partition(":")
+        token_file = args.token_file or os.path.join(str(Path.home()), WORKER_TOKEN_FILE)
+        token = worker_token(token_file)
+        if not token:
+            print("No worker token in {}, copy it from coordinator host".format(token_file))
+            sys.exit(1)
+        try:
+            WorkerDaemon((host, int(port or WORKER_PORT)), token, args.slots, args.paths).run()
+        except KeyboardInterrupt:
+            pass
+    else:
+        Service(args.group_slots, args.history, args.stall_timeout, args.stall_kill, args.deploy_timeout).run(args.listen, args.listen_address, args.token_file)
+
 if __name__ == "__main__":
-    Service().run()
+    main()